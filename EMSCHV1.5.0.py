@@ -1,34 +1,526 @@
 # EMSCH V1.5.0.py
 from fastapi import FastAPI, UploadFile, File, Request, Form
-from fastapi.responses import HTMLResponse, RedirectResponse
+from fastapi.responses import HTMLResponse, RedirectResponse, StreamingResponse, FileResponse, Response, JSONResponse
 from starlette.middleware.sessions import SessionMiddleware
 import cv2
 import numpy as np
-import shutil
+import hashlib
+import zlib
+import io
+import uuid
+import hmac
+import secrets
+import subprocess
+import http.client
 import os
-import base64
-from typing import List
+import re
+import html
+import string
+import logging
+import math
+from typing import List, Optional
+from urllib.parse import urlencode, urlsplit
+import sys
+import shutil
+import argparse
 import json
+import pickle
 import sqlite3
+import asyncio
+import contextvars
+import atexit
+import queue
+import threading
+import time
+import tracemalloc
+from collections import OrderedDict
+from contextlib import asynccontextmanager, contextmanager
+from concurrent.futures import Future, ThreadPoolExecutor, ProcessPoolExecutor, wait as wait_futures
 from datetime import datetime
 
-app = FastAPI()
+try:
+    import resource    # peak RSS for the benchmark; not available on Windows
+except ImportError:
+    resource = None
+
+
+@asynccontextmanager
+async def lifespan(app):
+    # serving workers only; importing the module (pool processes, maintenance commands) starts nothing
+    await asyncio.to_thread(resume_jobs)
+    yield
+
+
+app = FastAPI(lifespan=lifespan)
+log = logging.getLogger("emsch")
 
 # ========== config ==========
 TEMPLATE_DIR = "templates"
 MAX_UPLOAD = 5
 THRESHOLD = 0.6
-SESSION_SECRET = "PLEASE_CHANGE_THIS_RANDOM_SECRET"
+SESSION_SECRET = os.environ.get("EMSCH_SESSION_SECRET", "")   # same value on every node; "" = SESSION_SECRET_FILE
+SESSION_SECRET_FILE = "session.secret"   # generated by the first worker to start, read by the others
 DB_PATH = "records.db"
+RECORD_STORE = os.environ.get("EMSCH_RECORD_STORE", "sqlite")   # "sqlite" (DB_PATH) or the URL of a record-server
+RECORD_STORE_TOKEN = os.environ.get("EMSCH_RECORD_TOKEN", "")   # shared by the record-server and its workers only
+RECORD_STORE_TIMEOUT = 10      # seconds per request to the record server
+DB_BUSY_TIMEOUT_MS = 5000
+DB_BATCH_SIZE = 200            # writes group-committed in one transaction
+DB_BATCH_WAIT = 0.05           # seconds the writer waits to fill a batch
+RECORDS_PAGE_SIZE = 60
+RECORDS_PAGE_MAX = 500
+DIVISIONS = ["北屯分隊", "南屯分隊", "太平分隊", "清水分隊"]
+STATIC_MAX_AGE = 365 * 24 * 3600   # static files are served under a content hash, so they never go stale
+MANIFEST_PATH = "manifests.json"   # expected equipment per vehicle type / vehicle id
+TEMPLATE_INDEX_PATH = "templates.idx"   # compiled by `build-index`; memory-mapped instead of decoding templates/
+TEMPLATE_CHECK_SECONDS = 2.0   # how often templates/ is re-scanned for changed files
+DETECT_POOL = "thread"         # "thread" or "process"
+DETECT_WORKERS = 4
+DETECT_QUEUE_SIZE = 16         # images allowed to wait for a free worker
+BUSY_RETRY_SECONDS = 5
+RESULT_CACHE_SIZE = 256        # recent photos whose detections are reused when the same file is sent again
+JOB_DIR = "jobs"               # photos of background inspections until they are processed
+JOB_WORKERS = 2                # background inspections run at the same time
+JOB_QUEUE_MAX = 200            # queued background inspections before new ones are refused
+JOB_REFRESH_SECONDS = 2        # job page reload interval while it is still running
+JOB_STALE_SECONDS = 120        # a running job without progress for this long is taken over by another worker
+JOB_RECOVER_SECONDS = 30       # how often idle job workers look for queued or stale jobs
+UPLOAD_DIR = "uploads"         # chunks and assembled photos of resumable uploads
+UPLOAD_CHUNK_SIZE = 256 * 1024   # bytes per chunk; small enough to get through on weak in-vehicle Wi-Fi
+UPLOAD_MAX_BYTES = 40 * 1024 * 1024   # per photo
+UPLOAD_SESSION_TTL = 24 * 3600   # unfinished upload sessions are deleted after this many seconds
+UPLOAD_LOCK_STALE = 120        # a finish or photo assembly whose worker stopped touching its lock is taken over
+MATCH_WORKERS = os.cpu_count() or 1   # threads for (image, template) match jobs, 0 = sequential
+MATCH_ENGINE = "exhaustive"    # "exhaustive", "pyramid" (coarse-to-fine), "fft" (precomputed spectra) or "orb" (keypoint index)
+PYRAMID_LEVELS = 2             # pyrDown steps for the coarse search
+PYRAMID_TOP_K = 3              # coarse candidates refined at full resolution
+PYRAMID_MIN_SIZE = 12          # smallest template side allowed at the coarse level
+PYRAMID_VERIFY = False         # also run the exhaustive search and record the score delta
+FFT_CACHE_SHAPES = 2           # image sizes whose template spectra are kept in memory
+FFT_VERIFY = False             # also run cv2.matchTemplate and record the score delta
+FFT_TOLERANCE = 1e-4           # allowed score difference against cv2.matchTemplate
+ORB_INDEX_DIR = "orb_index"    # template keypoint descriptors, keyed by template content
+ORB_FEATURES = 500             # keypoints kept per template
+ORB_PHOTO_FEATURES = 5000      # keypoints taken from each photo
+ORB_PATCH_SIZE = 31            # lower it for small template crops
+ORB_RATIO = 0.8                # nearest / second nearest distance allowed (ratio test)
+ORB_MIN_MATCHES = 8            # matches a template needs before a homography is tried
+ORB_FULL_INLIERS = 30          # RANSAC inliers that count as score 1.0
+PRESENCE_MODE = False          # stop matching a device once it is confidently found
+PRESENCE_MARGIN = 0.15         # score above THRESHOLD that counts as confident
+MATCH_SCALES = (1.0,)          # photo / template size ratios searched, e.g. (0.8, 0.9, 1.0, 1.1, 1.25)
+MATCH_ROTATIONS = (0,)         # template tilts searched in degrees, e.g. (-10, -5, 0, 5, 10)
+MATCH_PRUNE_MARGIN = 0.1       # half-resolution scores this far below max(THRESHOLD, best so far) are dropped
+MATCH_REFINE_TOP = 2           # scale / rotation variants per template re-matched at full resolution
+ROI_SEARCH = True              # search where the vehicle's equipment was found last time before the whole photo
+ROI_PADDING = 1.0              # the search window grows by this many box widths / heights on each side
+ROI_HISTORY = 10               # recent inspections of the vehicle looked at for last positions
+WORK_MAX_SIDE = 0              # long side photos are resized to before detection, 0 = full size
+TEMPLATE_REF_SIDE = 4000       # long side of the photos the templates were cropped from
+CLIENT_MAX_SIDE = 0            # with WORK_MAX_SIDE: long side the upload form shrinks photos to, 0 = WORK_MAX_SIDE
+CLIENT_MIN_TEMPLATE_SIDE = 40  # without WORK_MAX_SIDE the upload form shrinks photos until the smallest template
+                               # would be this many pixels; the server shrinks the templates by the same factor
+CLIENT_JPEG_QUALITY = 90       # JPEG quality of photos re-encoded in the browser
+AUDIT_DIR = ""                 # keep uploaded originals here (content-addressed), "" = off
+PREVIEW_DIR = "previews"       # annotated result images served by /preview
+PREVIEW_SIZES = {"thumb": 320, "medium": 960}   # long side of cached thumbnails
+PREVIEW_QUALITY = 85
+PREVIEW_RETENTION_DAYS = 180   # previews not written or reused for this long are deleted, 0 = keep forever
+PREVIEW_SWEEP_SECONDS = 3600   # how often a worker looks for expired previews
+METRICS_ENABLED = True         # stage timers and request counters, served on /metrics
+METRICS_TOKEN = ""             # lets a scraper read /metrics with ?token=..., "" = logged-in users only
+ADMIN_TOKEN = ""               # required (?token=...) by /admin/templates/reload, "" = reloading over HTTP is off
+SERVER_TIMING = False          # add a Server-Timing header with the stages finished before the response starts
 # ============================
 
+def load_session_secret():
+    # every worker has to sign cookies with the same key; the first one to start writes the file
+    if SESSION_SECRET:
+        return SESSION_SECRET
+    if not os.path.exists(SESSION_SECRET_FILE):
+        tmp = "{}.{}.tmp".format(SESSION_SECRET_FILE, uuid.uuid4().hex)
+        with open(tmp, "w") as f:
+            f.write(secrets.token_hex(32))
+        try:
+            os.link(tmp, SESSION_SECRET_FILE)    # fails when another worker won the race
+        except FileExistsError:
+            pass
+        finally:
+            os.remove(tmp)
+    with open(SESSION_SECRET_FILE) as f:
+        return f.read().strip()
+
+
+SESSION_KEY = load_session_secret()
+
 # add session middleware
-app.add_middleware(SessionMiddleware, secret_key=SESSION_SECRET)
+app.add_middleware(SessionMiddleware, secret_key=SESSION_KEY)
+
+
+# ---------- metrics ----------
+METRIC_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+METRIC_HELP = {
+    "emsch_requests_total": ("counter", "HTTP requests by route, method and status"),
+    "emsch_request_seconds": ("histogram", "time until the response starts, by route"),
+    "emsch_stage_seconds": ("histogram", "upload pipeline stages"),
+    "emsch_template_match_seconds": ("histogram", "one template matched against one photo"),
+    "emsch_db_seconds": ("histogram", "database operations"),
+}
+
+
+class Metrics:
+    # in-process counters and fixed-bucket histograms in the Prometheus text format
+    def __init__(self, buckets=METRIC_BUCKETS):
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._histograms = {}
+
+    def inc(self, name, value=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + value
+
+    def observe(self, name, seconds, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._histograms.setdefault(name, {})
+            hist = series.get(key)
+            if hist is None:
+                hist = series[key] = [0] * len(self.buckets) + [0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    hist[i] += 1
+            hist[-2] += seconds
+            hist[-1] += 1
+
+    def render(self, gauges=()):
+        def fmt(labels):
+            if not labels:
+                return ""
+            return "{" + ",".join('{}="{}"'.format(k, str(v).replace("\\", "\\\\").replace('"', '\\"'))
+                                  for k, v in labels) + "}"
+
+        lines = []
+        with self._lock:
+            for name, series in sorted(self._counters.items()):
+                lines += ["# HELP {} {}".format(name, METRIC_HELP.get(name, ("", name))[1]),
+                          "# TYPE {} counter".format(name)]
+                lines += ["{}{} {}".format(name, fmt(labels), value) for labels, value in sorted(series.items())]
+            for name, series in sorted(self._histograms.items()):
+                lines += ["# HELP {} {}".format(name, METRIC_HELP.get(name, ("", name))[1]),
+                          "# TYPE {} histogram".format(name)]
+                for labels, hist in sorted(series.items()):
+                    for bound, count in zip(self.buckets, hist):
+                        lines.append("{}_bucket{} {}".format(name, fmt(labels + (("le", bound),)), count))
+                    lines.append("{}_bucket{} {}".format(name, fmt(labels + (("le", "+Inf"),)), hist[-1]))
+                    lines.append("{}_sum{} {:.6f}".format(name, fmt(labels), hist[-2]))
+                    lines.append("{}_count{} {}".format(name, fmt(labels), hist[-1]))
+        for name, value in gauges:
+            kind = "counter" if name.endswith("_total") else "gauge"
+            lines += ["# TYPE {} {}".format(name, kind), "{} {}".format(name, value)]
+        return "\n".join(lines) + "\n"
+
+
+METRICS = Metrics()
+# stage durations of the current request, for Server-Timing
+REQUEST_TIMINGS = contextvars.ContextVar("request_timings", default=None)
+
+
+def record_stage(stage, seconds):
+    if not METRICS_ENABLED:
+        return
+    METRICS.observe("emsch_stage_seconds", seconds, stage=stage)
+    timings = REQUEST_TIMINGS.get()
+    if timings is not None:
+        timings[stage] = timings.get(stage, 0.0) + seconds
+
+
+@contextmanager
+def stage_timer(stage, timings=None):
+    # with timings, the duration is only collected there (detection workers hand it back to the request);
+    # otherwise it goes straight to the metrics
+    if not METRICS_ENABLED:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        if timings is not None:
+            timings[stage] = timings.get(stage, 0.0) + elapsed
+        else:
+            record_stage(stage, elapsed)
+
+
+@contextmanager
+def db_timer(op):
+    if not METRICS_ENABLED:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        METRICS.observe("emsch_db_seconds", time.perf_counter() - started, op=op)
+
+
+class MetricsMiddleware:
+    # plain ASGI so streamed responses pass through untouched
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        started = time.perf_counter()
+        timings = {}
+        REQUEST_TIMINGS.set(timings)
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                elapsed = time.perf_counter() - started
+                route = scope.get("route")
+                path = getattr(route, "path", "unmatched")
+                METRICS.inc("emsch_requests_total", route=path, method=scope["method"], status=message["status"])
+                METRICS.observe("emsch_request_seconds", elapsed, route=path)
+                if SERVER_TIMING:
+                    entries = ["{};dur={:.1f}".format(stage, t * 1000) for stage, t in timings.items()]
+                    entries.append("app;dur={:.1f}".format(elapsed * 1000))
+                    message.setdefault("headers", [])
+                    message["headers"] = list(message["headers"]) + [
+                        (b"server-timing", ", ".join(entries).encode("latin-1"))]
+            await send(message)
+
+        await self.app(scope, receive, send_wrapper)
+
+
+if METRICS_ENABLED:
+    app.add_middleware(MetricsMiddleware)
 
 
 # ---------- database ----------
+def connect_db():
+    conn = sqlite3.connect(DB_PATH, timeout=DB_BUSY_TIMEOUT_MS / 1000, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA busy_timeout={}".format(DB_BUSY_TIMEOUT_MS))
+    return conn
+
+
+_db_local = threading.local()
+
+
+def db():
+    # one long-lived read connection per thread (a RecordClient when records live on a record-server)
+    conn = getattr(_db_local, "conn", None)
+    if conn is None:
+        if RECORD_STORE == "sqlite":
+            conn = connect_db()
+            conn.execute("PRAGMA query_only = ON")
+        else:
+            conn = RecordClient(RECORD_STORE)
+        _db_local.conn = conn
+    return conn
+
+
+# reads by name, like WRITE_OPS: a record-server runs these and never SQL sent by a client;
+# arguments and results must be JSON-serialisable
+READ_OPS = {}
+
+
+def read_op(fn):
+    READ_OPS[fn.__name__] = fn
+    return fn
+
+
+def read(op, *args):
+    # rows come back as tuples locally and as lists from a record-server
+    conn = db()
+    if isinstance(conn, RecordClient):
+        return conn.request("/read", {"op": op, "args": list(args)})["result"]
+    return READ_OPS[op](conn, *args)
+
+
+class RecordWriter:
+    # single writer thread; queued writes are group-committed in one transaction
+    def __init__(self, batch_size=DB_BATCH_SIZE, batch_wait=DB_BATCH_WAIT):
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+        self.written = 0
+        self.failed = 0
+        self.batches = 0
+        self.max_batch = 0
+
+    def submit(self, fn):
+        # fn(cursor) runs on the writer thread; the future resolves after commit
+        future = Future()
+        self._ensure_thread()
+        self._queue.put((fn, future))
+        return future
+
+    def write(self, op, *args):
+        # a named write from WRITE_OPS; the same call works against a record-server
+        fn = WRITE_OPS[op]
+        return self.submit(lambda c: fn(c, *args))
+
+    def flush(self, timeout=None):
+        if self._thread is None:
+            return
+        self.write("noop").result(timeout)
+
+    def _ensure_thread(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="record-writer", daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        conn = connect_db()
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.batch_wait
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                try:
+                    batch.append(self._queue.get(timeout=max(remaining, 0)) if remaining > 0
+                                 else self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            self._write(conn, batch)
+
+    def _write(self, conn, batch):
+        results = []
+        cur = conn.cursor()
+        try:
+            cur.execute("BEGIN IMMEDIATE")
+            for fn, future in batch:
+                # a savepoint per write keeps one bad row from failing the whole batch
+                cur.execute("SAVEPOINT write")
+                try:
+                    results.append((future, fn(cur), None))
+                    cur.execute("RELEASE write")
+                except Exception as e:
+                    log.exception("record write failed")
+                    cur.execute("ROLLBACK TO write")
+                    cur.execute("RELEASE write")
+                    results.append((future, None, e))
+            cur.execute("COMMIT")
+        except Exception as e:
+            log.exception("record batch failed")
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            results = [(future, None, e) for _, future in batch]
+
+        self.batches += 1
+        self.max_batch = max(self.max_batch, len(batch))
+        for future, value, error in results:
+            if error is None:
+                self.written += 1
+                future.set_result(value)
+            else:
+                self.failed += 1
+                future.set_exception(error)
+
+    def stats(self):
+        return {
+            "queued": self._queue.qsize(),
+            "written": self.written,
+            "failed": self.failed,
+            "batches": self.batches,
+            "max_batch": self.max_batch,
+        }
+
+
+class RecordClient:
+    # talks to a record-server: named reads and writes as JSON, with its own token (not the session key).
+    # use an https:// URL when the record server is reached over an untrusted network
+    def __init__(self, url):
+        self.url = urlsplit(url)
+        self._conn = None
+
+    def request(self, path, payload):
+        body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        headers = {"Content-Type": "application/json", "Authorization": "Bearer " + RECORD_STORE_TOKEN}
+        for attempt in (1, 2):
+            # keep-alive connection per thread; reconnect once if the server closed it
+            if self._conn is None:
+                if self.url.scheme == "https":
+                    self._conn = http.client.HTTPSConnection(self.url.hostname, self.url.port or 443,
+                                                             timeout=RECORD_STORE_TIMEOUT)
+                else:
+                    self._conn = http.client.HTTPConnection(self.url.hostname, self.url.port or 80,
+                                                            timeout=RECORD_STORE_TIMEOUT)
+            try:
+                self._conn.request("POST", path, body, headers)
+                response = self._conn.getresponse()
+                data = json.loads(response.read().decode("utf-8"))
+                break
+            except (OSError, http.client.HTTPException) as e:
+                self._conn.close()
+                self._conn = None
+                if attempt == 2:
+                    raise sqlite3.OperationalError("record server unreachable: {}".format(e))
+        if response.status != 200:
+            raise sqlite3.OperationalError("record server: {}".format(data.get("error", response.status)))
+        return data
+
+
+class RemoteWriter:
+    # write side of a record-server; the server group-commits what all workers send
+    def __init__(self, url, workers=8):
+        self.url = url
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="record-client")
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._pending = set()
+        self.written = 0
+        self.failed = 0
+
+    def _send(self, op, args):
+        remote = getattr(self._local, "remote", None)
+        if remote is None:
+            remote = self._local.remote = RecordClient(self.url)
+        try:
+            result = remote.request("/write", {"op": op, "args": args})["result"]
+        except Exception:
+            log.exception("record write %s failed", op)
+            self.failed += 1
+            raise
+        self.written += 1
+        return result
+
+    def write(self, op, *args):
+        future = self._executor.submit(self._send, op, args)
+        with self._lock:
+            self._pending.add(future)
+        future.add_done_callback(self._done)
+        return future
+
+    def _done(self, future):
+        with self._lock:
+            self._pending.discard(future)
+
+    def flush(self, timeout=None):
+        with self._lock:
+            pending = list(self._pending)
+        wait_futures(pending, timeout)
+
+    def stats(self):
+        return {"store": self.url, "written": self.written, "failed": self.failed}
+
+
+RECORD_WRITER = RecordWriter() if RECORD_STORE == "sqlite" else RemoteWriter(RECORD_STORE)
+atexit.register(RECORD_WRITER.flush, 10)
+
+
 def init_db():
-    conn = sqlite3.connect(DB_PATH)
+    conn = connect_db()
     c = conn.cursor()
     c.execute(
         """
@@ -43,335 +535,3752 @@ def init_db():
         )
         """
     )
-    conn.commit()
+    # rowid is the implicit last column of every index, so these also serve ORDER BY id
+    for column in ("division", "username", "vehicle_type", "vehicle_id", "timestamp"):
+        c.execute("CREATE INDEX IF NOT EXISTS idx_records_{0} ON records ({0})".format(column))
+    migrate(conn)
     conn.close()
 
 
-def save_record(division, username, vehicle_type, vehicle_id, results_dict):
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute(
-        "INSERT INTO records (timestamp, division, username, vehicle_type, vehicle_id, results) VALUES (?, ?, ?, ?, ?, ?)",
-        (datetime.utcnow().isoformat(), division, username, vehicle_type, vehicle_id, json.dumps(results_dict, ensure_ascii=False))
+# schema changes, applied in order; PRAGMA user_version holds how many have run
+MIGRATIONS = [
+    # 1: one row per image and device instead of parsing records.results
+    """
+    CREATE TABLE IF NOT EXISTS detections (
+        id INTEGER PRIMARY KEY,
+        record_id INTEGER NOT NULL REFERENCES records(id),
+        image TEXT,
+        device TEXT,
+        score REAL,
+        detected INTEGER,
+        template TEXT
+    );
+    CREATE INDEX IF NOT EXISTS idx_detections_record ON detections (record_id, device, detected);
+    """,
+    # 2: expected equipment that no photo of the inspection showed
+    """
+    ALTER TABLE records ADD COLUMN missing TEXT;
+    """,
+    # 3: background inspections; status is queued, running, done or failed
+    """
+    CREATE TABLE IF NOT EXISTS jobs (
+        id TEXT PRIMARY KEY,
+        created TEXT,
+        updated TEXT,
+        status TEXT,
+        division TEXT,
+        username TEXT,
+        vehicle_type TEXT,
+        vehicle_id TEXT,
+        filenames TEXT,
+        total INTEGER,
+        done INTEGER,
+        cards TEXT,
+        record_id INTEGER,
+        error TEXT
+    );
+    CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs (status);
+    """,
+    # 4: photo hashes per record; the dHash is split in four 16-bit bands so near duplicates are an index lookup
+    """
+    CREATE TABLE IF NOT EXISTS photos (
+        id INTEGER PRIMARY KEY,
+        record_id INTEGER NOT NULL REFERENCES records(id),
+        image TEXT,
+        sha256 TEXT,
+        dhash TEXT,
+        b0 INTEGER,
+        b1 INTEGER,
+        b2 INTEGER,
+        b3 INTEGER
+    );
+    CREATE INDEX IF NOT EXISTS idx_photos_record ON photos (record_id);
+    CREATE INDEX IF NOT EXISTS idx_photos_b0 ON photos (b0);
+    CREATE INDEX IF NOT EXISTS idx_photos_b1 ON photos (b1);
+    CREATE INDEX IF NOT EXISTS idx_photos_b2 ON photos (b2);
+    CREATE INDEX IF NOT EXISTS idx_photos_b3 ON photos (b3);
+    ALTER TABLE records ADD COLUMN reused TEXT;
+    """,
+    # 5: where a detected device was, as fractions of the upright photo, for the ROI search next time
+    """
+    ALTER TABLE detections ADD COLUMN x REAL;
+    ALTER TABLE detections ADD COLUMN y REAL;
+    ALTER TABLE detections ADD COLUMN w REAL;
+    ALTER TABLE detections ADD COLUMN h REAL;
+    """,
+    # 6: reused photos are matched by content hash only; a near-identical dHash is just the same angle
+    """
+    CREATE INDEX IF NOT EXISTS idx_photos_sha256 ON photos (sha256);
+    """,
+    # 7: annotated preview per photo, so a record page shows the same images as the live result
+    """
+    ALTER TABLE photos ADD COLUMN preview TEXT;
+    """,
+    # 8: token of the worker run that claimed a job; only that run may update or close it
+    """
+    ALTER TABLE jobs ADD COLUMN owner TEXT;
+    """,
+    # 9: reuse is matched on sha256 only (6), so the dHash band indexes go; the dhash and b0..b3 columns stay
+    # NULL from now on (dropping columns needs SQLite 3.35)
+    """
+    DROP INDEX IF EXISTS idx_photos_b0;
+    DROP INDEX IF EXISTS idx_photos_b1;
+    DROP INDEX IF EXISTS idx_photos_b2;
+    DROP INDEX IF EXISTS idx_photos_b3;
+    """,
+]
+
+
+def sql_statements(script):
+    statement = ""
+    for line in script.splitlines(keepends=True):
+        statement += line
+        if sqlite3.complete_statement(statement):
+            yield statement
+            statement = ""
+
+
+def migrate(conn):
+    # the version is re-read inside each write transaction, so workers starting together apply a step once
+    for number, script in enumerate(MIGRATIONS, start=1):
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            if conn.execute("PRAGMA user_version").fetchone()[0] < number:
+                for statement in sql_statements(script):
+                    conn.execute(statement)
+                conn.execute("PRAGMA user_version = {}".format(number))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+
+def detection_rows(record_id, results_dict):
+    return [
+        (record_id, image, device, info["score"], int(bool(info["detected"])), info["template"],
+         *(info.get("box") or (None, None, None, None)))
+        for image, device_res in results_dict.items()
+        for device, info in device_res.items()
+    ]
+
+
+def insert_detections(c, record_id, results_dict):
+    c.executemany(
+        "INSERT INTO detections (record_id, image, device, score, detected, template, x, y, w, h) "
+        "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+        detection_rows(record_id, results_dict)
     )
-    conn.commit()
-    conn.close()
 
 
-def get_recent_records(limit=50):
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute("SELECT id, timestamp, division, username, vehicle_type, vehicle_id, results FROM records ORDER BY id DESC LIMIT ?", (limit,))
-    rows = c.fetchall()
-    conn.close()
-    return rows
+@read_op
+def recent_positions(c, vehicle_id, history):
+    return c.execute(
+        "SELECT d.record_id, d.device, d.x, d.y, d.w, d.h FROM detections d "
+        "JOIN (SELECT id FROM records WHERE vehicle_id = ? ORDER BY id DESC LIMIT ?) r ON r.id = d.record_id "
+        "WHERE d.detected = 1 AND d.x IS NOT NULL ORDER BY d.record_id DESC",
+        (vehicle_id, history)
+    ).fetchall()
 
 
-# ---------- helper functions ----------
-def load_templates():
-    templates = {}
-    if not os.path.exists(TEMPLATE_DIR):
-        return templates
-    for filename in os.listdir(TEMPLATE_DIR):
-        if filename.lower().endswith((".jpg", ".jpeg", ".png")):
-            path = os.path.join(TEMPLATE_DIR, filename)
-            img = cv2.imread(path, cv2.IMREAD_GRAYSCALE)
-            if img is not None:
-                name = os.path.splitext(filename)[0]
-                templates[name] = img
-    return templates
+def last_positions(vehicle_id):
+    # {device: [box, ...]} from the latest of the vehicle's recent inspections that found the device;
+    # boxes are (x, y, w, h) fractions of the photo
+    with db_timer("last_positions"):
+        rows = read("recent_positions", vehicle_id, ROI_HISTORY)
+    positions = {}
+    latest = {}
+    for record_id, device, x, y, w, h in rows:
+        if latest.setdefault(device, record_id) == record_id:
+            positions.setdefault(device, []).append((x, y, w, h))
+    return positions
 
 
-def imencode_to_base64(img_bgr, ext=".jpg"):
-    success, encoded = cv2.imencode(ext, img_bgr)
-    if not success:
-        return None
-    b64 = base64.b64encode(encoded.tobytes()).decode("utf-8")
-    return b64
+def insert_photos(c, record_id, photos):
+    # stores the photo hashes and returns earlier records that had the very same photo file.
+    # a near-identical photo is usually just the same compartment shot from the same spot, so it is not flagged
+    reused = []
+    for image, photo in photos.items():
+        rows = c.execute(
+            "SELECT record_id, image FROM photos WHERE sha256 = ? AND record_id != ?", (photo["sha256"], record_id)
+        ).fetchall()
+        for prev_record, prev_image in rows:
+            reused.append({"image": image, "record_id": prev_record, "previous_image": prev_image, "exact": True})
+        c.execute("INSERT INTO photos (record_id, image, sha256, preview) VALUES (?, ?, ?, ?)",
+                  (record_id, image, photo["sha256"], photo.get("preview")))
+    return reused
 
 
-# ---------- routes ----------
-@app.get("/", response_class=HTMLResponse)
-async def root(request: Request):
-    if request.session.get("user"):
-        return RedirectResponse(url="/upload_form")
+# writes by name, so they can run on a record-server as well as on the local writer thread;
+# arguments must be JSON-serialisable
+WRITE_OPS = {}
 
-    divisions = ["北屯分隊", "南屯分隊", "太平分隊", "清水分隊"]
-    options_html = "".join([f"<option value='{d}'>{d}</option>" for d in divisions])
 
-    page = """
-    <html>
-      <head>
-        <meta name="viewport" content="width=device-width, initial-scale=1">
-        <title>登入 - 救護車設備 AI</title>
-        <style>
-          body{font-family:Arial; background:#f4f7fb; padding:18px}
-          .box{max-width:420px; margin:40px auto; background:#fff; padding:18px; border-radius:10px; box-shadow:0 6px 18px rgba(18,24,40,0.06)}
-          input, select{width:100%; padding:10px; margin-top:8px; border-radius:6px; border:1px solid #ddd}
-          button{background:#1e88ff; color:#fff; border:none; padding:12px; border-radius:8px; width:100%; margin-top:12px}
-        </style>
-      </head>
-      <body>
-        <div class="box">
-          <h2 style="text-align:center">🔐 登入 - 救護車設備 AI</h2>
-          <form action="/login" method="post">
-            <label>分隊</label>
-            <select name="division" required>""" + options_html + """</select>
-            <label style="margin-top:8px">隊員姓名</label>
-            <input name="username" placeholder="輸入隊員姓名" required>
-            <button type="submit">登入</button>
-          </form>
-        </div>
-      </body>
-    </html>
-    """
-    return HTMLResponse(page)
+def write_op(fn):
+    WRITE_OPS[fn.__name__] = fn
+    return fn
 
 
-@app.post("/login")
-async def login(request: Request, division: str = Form(...), username: str = Form(...)):
-    request.session["user"] = username
-    request.session["division"] = division
-    return RedirectResponse(url="/upload_form", status_code=303)
+@write_op
+def insert_record(c, row, results_dict, job_id=None, photos=None, job_owner=None):
+    # a background job is closed in the same transaction, so a restart never saves it twice;
+    # a run whose job was taken over by another worker saves nothing
+    if job_id is not None and c.execute("SELECT 1 FROM jobs WHERE id = ? AND owner = ? AND status = 'running'",
+                                        (job_id, job_owner)).fetchone() is None:
+        raise sqlite3.IntegrityError("job {} is no longer owned by this run".format(job_id))
+    c.execute(
+        "INSERT INTO records (timestamp, division, username, vehicle_type, vehicle_id, results, missing) VALUES (?, ?, ?, ?, ?, ?, ?)",
+        row
+    )
+    record_id = c.lastrowid
+    insert_detections(c, record_id, results_dict)
+    if photos:
+        reused = insert_photos(c, record_id, photos)
+        if reused:
+            c.execute("UPDATE records SET reused = ? WHERE id = ?",
+                      (json.dumps(reused, ensure_ascii=False), record_id))
+    if job_id is not None:
+        c.execute("UPDATE jobs SET status = 'done', record_id = ?, updated = ? WHERE id = ?",
+                  (record_id, row[0], job_id))
+    return record_id
 
 
-@app.get("/logout")
-async def logout(request: Request):
-    request.session.clear()
-    return RedirectResponse(url="/")
+@write_op
+def noop(c):
+    return None
 
 
-@app.get("/upload_form", response_class=HTMLResponse)
-async def upload_form(request: Request):
-    if not request.session.get("user"):
-        return RedirectResponse(url="/")
+def save_record(division, username, vehicle_type, vehicle_id, results_dict, missing=None, job_id=None, photos=None,
+                job_owner=None):
+    # queued for the writer; returns a future with the new record id
+    row = (datetime.utcnow().isoformat(), division, username, vehicle_type, vehicle_id,
+           json.dumps(results_dict, ensure_ascii=False),
+           None if missing is None else json.dumps(missing, ensure_ascii=False))
+    future = RECORD_WRITER.write("insert_record", row, results_dict, job_id, photos, job_owner)
+    if METRICS_ENABLED:
+        # submit to commit, including the wait for the group-commit batch
+        started = time.perf_counter()
+        future.add_done_callback(
+            lambda f: METRICS.observe("emsch_db_seconds", time.perf_counter() - started, op="save_record"))
+    return future
 
-    user = request.session["user"]
-    division = request.session["division"]
 
-    page = """
-    <html>
-      <head>
-        <meta name="viewport" content="width=device-width, initial-scale=1">
-        <title>上傳 - 救護車設備 AI</title>
-        <style>
-          body{font-family:Arial; background:#f4f7fb; padding:18px}
-          .container{max-width:780px; margin:12px auto}
-          .card{background:#fff; padding:16px; border-radius:10px; box-shadow:0 6px 18px rgba(18,24,40,0.06)}
-          input[type=file]{width:100%}
-          .row{display:flex; gap:8px; flex-wrap:wrap}
-          select, input[type=text]{flex:1; padding:10px; border-radius:8px; border:1px solid #ddd}
-          button.primary{background:#1e88ff; color:#fff; border:none; padding:12px; border-radius:8px; width:100%}
-        </style>
-      </head>
-      <body>
-        <div class="container">
-          <div style="display:flex; justify-content:space-between; align-items:center; margin-bottom:8px;">
-            <div><strong>分隊：</strong>""" + division + """ &nbsp;&nbsp; <strong>隊員：</strong>""" + user + """</div>
-            <div><a href="/logout">登出</a></div>
-          </div>
+def backfill_detections(batch_size=500):
+    # fills detections for records written before the table existed, one batch per transaction
+    conn = connect_db()
+    last_id = 0
+    records = 0
+    rows = 0
+    while True:
+        batch = conn.execute(
+            "SELECT id, results FROM records WHERE id > ? AND NOT EXISTS "
+            "(SELECT 1 FROM detections d WHERE d.record_id = records.id) ORDER BY id LIMIT ?",
+            (last_id, batch_size)
+        ).fetchall()
+        if not batch:
+            break
+        c = conn.cursor()
+        c.execute("BEGIN IMMEDIATE")
+        for record_id, results in batch:
+            try:
+                results_dict = json.loads(results) if results else {}
+            except ValueError:
+                log.warning("record %s has unreadable results, skipped", record_id)
+                continue
+            insert_detections(c, record_id, results_dict)
+            rows += c.rowcount if c.rowcount > 0 else 0
+        c.execute("COMMIT")
+        records += len(batch)
+        last_id = batch[-1][0]
+        print("backfilled up to record {} ({} records, {} detections)".format(last_id, records, rows))
+    conn.close()
+    return records, rows
 
-          <div class="card">
-            <h3>📸 上傳檢查照片 (最多 """ + str(MAX_UPLOAD) + """ 張)</h3>
-            <form action="/upload" enctype="multipart/form-data" method="post">
-              <div style="margin-bottom:8px;" class="row">
-                <select name="vehicle_type" required>
-                  <option value="救護車">救護車</option>
-                  <option value="消防車">消防車</option>
-                </select>
-                <input type="text" name="vehicle_id" placeholder="車輛編號 (例如 A1-1)" required>
-              </div>
-              <input type="file" name="files" accept="image/*" multiple required>
-              <br><br>
-              <button class="primary" type="submit">上傳並檢查</button>
-            </form>
-            <small style="color:#666">Templates: """ + TEMPLATE_DIR + """</small>
-          </div>
 
-          <div style="text-align:center; margin-top:12px;">
-            <a href="/records">查看最近紀錄</a>
-          </div>
-        </div>
-      </body>
-    </html>
-    """
-    return HTMLResponse(page)
+RECORD_COLUMNS = ["id", "timestamp", "division", "username", "vehicle_type", "vehicle_id", "missing", "reused"]
+RECORD_FILTERS = {
+    "division": "division = ?",
+    "vehicle_type": "vehicle_type = ?",
+    "vehicle_id": "vehicle_id = ?",
+    "username": "username = ?",
+    # a time range is narrowed to an id range, so rows still come back in id order. finding the bound is
+    # an index-only range scan over the timestamps on that side (not a seek): cheap for recent or short
+    # ranges, roughly 80 ms per million records spanned. "+timestamp" keeps the exact check off the index
+    "since": "id >= (SELECT MIN(id) FROM records INDEXED BY idx_records_timestamp WHERE timestamp >= ?) AND +timestamp >= ?",
+    "until": "id <= (SELECT MAX(id) FROM records INDEXED BY idx_records_timestamp WHERE timestamp < ?) AND +timestamp < ?",
+}
 
 
-@app.post("/upload", response_class=HTMLResponse)
-async def upload(request: Request, files: List[UploadFile] = File(...),
-                 vehicle_type: str = Form(...), vehicle_id: str = Form(...)):
+DATE_ONLY = re.compile(r"\d{4}-\d{2}-\d{2}")
 
-    if not request.session.get("user"):
-        return RedirectResponse(url="/")
 
-    user = request.session["user"]
-    division = request.session["division"]
+def filter_value(key, value):
+    # "until" a day typed as YYYY-MM-DD includes that day (T24:00 is its end in ISO 8601)
+    if key == "until" and DATE_ONLY.fullmatch(value):
+        return value + "T24:00"
+    return value
 
-    if len(files) == 0:
-        return HTMLResponse("<h3>❌ 請上傳至少一張圖片</h3>")
-    if len(files) > MAX_UPLOAD:
-        return HTMLResponse("<h3>❌ 最多上傳 {} 張圖片</h3>".format(MAX_UPLOAD))
 
-    templates = load_templates()
-    if not templates:
-        return HTMLResponse("<h3>❌ templates 資料夾中沒有模板圖片！</h3>")
+def filter_clauses(filters):
+    # WHERE parts for the known RECORD_FILTERS keys; anything else in filters is ignored
+    where = []
+    params = []
+    for key, clause in RECORD_FILTERS.items():
+        if filters.get(key):
+            where.append(clause)
+            params.extend([filter_value(key, filters[key])] * clause.count("?"))
+    return where, params
+
 
+@read_op
+def select_records(c, filters, before_id, limit, include_results):
+    columns = RECORD_COLUMNS + (["results"] if include_results else [])
+    where, params = filter_clauses(filters)
+    if before_id is not None:
+        where.append("id < ?")
+        params.append(before_id)
+
+    sql = "SELECT {} FROM records".format(", ".join(columns))
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    sql += " ORDER BY id DESC LIMIT ?"
+    return c.execute(sql, params + [limit]).fetchall()
+
+
+def query_records(filters, before_id=None, limit=RECORDS_PAGE_SIZE, include_results=False):
+    # keyset pagination on id; returns (rows, before_id for the next page or None)
+    with db_timer("query_records"):
+        rows = read("select_records", filters, before_id, limit + 1, include_results)
+    if len(rows) > limit:
+        return rows[:limit], rows[limit - 1][0]
+    return rows, None
+
+
+# ---------- template store ----------
+TEMPLATE_EXTS = (".jpg", ".jpeg", ".png")
+
+
+def group_by_device(templates):
     device_templates = {}
     for tname, img in templates.items():
         key = tname.split("_")[0]
         device_templates.setdefault(key, []).append((tname, img))
+    return device_templates
 
-    all_results = {}
-    card_html = ""
 
-    for idx, file in enumerate(files, start=1):
-        tmp = f"up_{idx}.jpg"
-        with open(tmp, "wb") as buffer:
-            shutil.copyfileobj(file.file, buffer)
+class TemplateSet:
+    # immutable snapshot of the template library, shared by all requests
+    def __init__(self, templates, version, signature=""):
+        self.templates = templates
+        self.version = version
+        self.signature = signature    # same files -> same signature in every worker, unlike version
+        self.devices = group_by_device(templates)
+        self._derived = {}
+        self._lock = threading.Lock()
 
-        img = cv2.imread(tmp)
+    def derived(self, key, build):
+        # data computed from the templates (pyramids, ...) lives as long as this version
+        with self._lock:
+            value = self._derived.get(key)
+        if value is None:
+            value = build(self)
+            with self._lock:
+                value = self._derived.setdefault(key, value)
+        return value
+
+
+# ---------- compiled template index ----------
+# layout: magic, header length (uint64 little endian), JSON header, then 64-byte aligned uint8 arrays
+TEMPLATE_INDEX_MAGIC = b"EMSCHIDX"
+TEMPLATE_INDEX_ALIGN = 64
+
+
+def file_sha1(path):
+    with open(path, "rb") as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+def build_template_index(template_dir=TEMPLATE_DIR, path=TEMPLATE_INDEX_PATH):
+    # decodes templates/ once and writes the grayscale arrays and their pyramid levels into one file
+    files = []
+    for filename in sorted(os.listdir(template_dir)):
+        full = os.path.join(template_dir, filename)
+        if not (os.path.isfile(full) and filename.lower().endswith(TEMPLATE_EXTS)):
+            continue
+        img = cv2.imread(full, cv2.IMREAD_GRAYSCALE)
         if img is None:
+            log.warning("skipping unreadable template %s", filename)
             continue
-        gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+        files.append((filename, os.stat(full), img))
+    names = {filename: os.path.splitext(filename)[0] for filename, _, _ in files}
+    template_set = TemplateSet({names[f]: img for f, _, img in files}, 0)
+    pyramids = build_template_pyramids(template_set)
+    # the copy most uploads are matched against (WORK_MAX_SIDE or the upload form's shrink) goes in as well
+    scale = served_scale(template_set)
+    scaled = build_template_pyramids(scale_templates(template_set, scale)) if scale != 1 else {}
 
-        device_res = {}
-        best_boxes = {}
+    entries = []
+    blobs = []
+    offset = 0
 
-        for device, tlist in device_templates.items():
-            best_score = -1
-            best_loc = None
-            best_shape = None
-            best_tname = None
+    def add(levels):
+        nonlocal offset
+        arrays = {}
+        for level, array in enumerate(levels):
+            array = np.ascontiguousarray(array)
+            arrays[str(level)] = [offset, array.shape[0], array.shape[1]]
+            blobs.append((offset, array.tobytes()))
+            offset += -(-array.nbytes // TEMPLATE_INDEX_ALIGN) * TEMPLATE_INDEX_ALIGN
+        return arrays
 
-            for tname, tmpl in tlist:
-                try:
-                    if tmpl.shape[0] > gray.shape[0] or tmpl.shape[1] > gray.shape[1]:
-                        continue
-                    res = cv2.matchTemplate(gray, tmpl, cv2.TM_CCOEFF_NORMED)
-                    _, maxv, _, maxloc = cv2.minMaxLoc(res)
-                    if maxv > best_score:
-                        best_score = maxv
-                        best_loc = maxloc
-                        best_shape = tmpl.shape
-                        best_tname = tname
-                except:
-                    continue
+    for filename, st, img in files:
+        name = names[filename]
+        entry = {"file": filename, "name": name, "device": name.split("_")[0],
+                 "mtime_ns": st.st_mtime_ns, "size": st.st_size, "sha1": file_sha1(os.path.join(template_dir, filename)),
+                 "levels": add(pyramids[name])}
+        if scaled:
+            entry["scaled"] = add(scaled[name])
+        entries.append(entry)
 
-            device_res[device] = {
-                "score": best_score,
-                "detected": best_score >= THRESHOLD,
-                "template": best_tname
-            }
+    header = json.dumps({"format": 1, "pyramid": [PYRAMID_LEVELS, PYRAMID_MIN_SIZE], "scale": scale,
+                         "templates": entries}, ensure_ascii=False).encode("utf-8")
+    start = -(-(16 + len(header)) // TEMPLATE_INDEX_ALIGN) * TEMPLATE_INDEX_ALIGN
+    data = bytearray(start + offset)
+    data[:8] = TEMPLATE_INDEX_MAGIC
+    data[8:16] = len(header).to_bytes(8, "little")
+    data[16:16 + len(header)] = header
+    for blob_offset, blob in blobs:
+        data[start + blob_offset:start + blob_offset + len(blob)] = blob
+    write_atomic(path, bytes(data))
+    return len(entries), len(data)
 
-            if best_score >= THRESHOLD and best_loc and best_shape:
-                h, w = best_shape
-                best_boxes[device] = (best_loc, (best_loc[0] + w, best_loc[1] + h), best_score)
 
-        out = img.copy()
-        for device, (tl, br, score) in best_boxes.items():
-            cv2.rectangle(out, tl, br, (255, 0, 0), 2)
-            label = "{} ({:.2f})".format(device, score)
-            cv2.putText(out, label, (tl[0], tl[1] - 6),
-                        cv2.FONT_HERSHEY_SIMPLEX, 0.6, (255,0,0), 2)
+class TemplateIndex:
+    # read-only view of the compiled index; arrays are slices of one memory map, so process
+    # workers share the pages instead of each decoding its own copy. an entry is only used while
+    # its source file is unchanged (same mtime and size, or same content after a copy)
+    def __init__(self, path):
+        self.path = path
+        self._stat = None
+        self._entries = {}
+        self._map = None
+        self._start = 0
+        self.pyramid_params = None
+        self.scale = None    # of the scaled copies in the index, if any
 
-        b64 = imencode_to_base64(out)
-        preview = "<img src='data:image/jpeg;base64,{}' style='max-width:94%; border-radius:8px;'>".format(b64)
+    def _open(self):
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            self._stat, self._entries, self._map = None, {}, None
+            return
+        if self._stat == (st.st_mtime_ns, st.st_size):
+            return
+        self._stat = (st.st_mtime_ns, st.st_size)
+        self._entries, self._map = {}, None
+        try:
+            with open(self.path, "rb") as f:
+                if f.read(8) != TEMPLATE_INDEX_MAGIC:
+                    raise ValueError("not a template index")
+                length = int.from_bytes(f.read(8), "little")
+                header = json.loads(f.read(length).decode("utf-8"))
+            self._start = -(-(16 + length) // TEMPLATE_INDEX_ALIGN) * TEMPLATE_INDEX_ALIGN
+        except (OSError, ValueError):
+            log.exception("could not read template index %s", self.path)
+            return
+        self._map = np.memmap(self.path, dtype=np.uint8, mode="r")
+        self._entries = {entry["file"]: entry for entry in header["templates"]}
+        self.pyramid_params = header["pyramid"]
+        self.scale = header.get("scale")
 
-        # produce table rows
-        rows = ""
-        for device, info in device_res.items():
-            if info["score"] < THRESHOLD:
+    def _array(self, spec):
+        offset, h, w = spec
+        start = self._start + offset
+        return self._map[start:start + h * w].reshape(h, w)
+
+    def lookup(self, template_dir, filename, mtime, size):
+        # returns the pyramid levels (level 0 is the template) and those of the copy scaled by self.scale
+        # (or None), or None when the file is not in the index
+        self._open()
+        entry = self._entries.get(filename)
+        if entry is None or entry["size"] != size:
+            return None
+        if entry["mtime_ns"] != mtime and entry["sha1"] != file_sha1(os.path.join(template_dir, filename)):
+            return None
+        scaled = entry.get("scaled")
+        return self._levels(entry["levels"]), self._levels(scaled) if scaled else None
+
+    def _levels(self, arrays):
+        return [self._array(arrays[str(level)]) for level in range(len(arrays))]
+
+
+TEMPLATE_INDEX = TemplateIndex(TEMPLATE_INDEX_PATH) if TEMPLATE_INDEX_PATH else None
+
+
+class TemplateStore:
+    def __init__(self, template_dir, check_seconds=TEMPLATE_CHECK_SECONDS):
+        self.template_dir = template_dir
+        self.check_seconds = check_seconds
+        # touched by an admin reload, so the other workers reload on their next request too
+        self.generation_path = os.path.join(template_dir, ".generation")
+        self._generation = self._read_generation()
+        self._lock = threading.Lock()
+        self._files = {}    # filename -> (mtime_ns, size, name, gray image)
+        self._pyramids = {}    # name -> pyramid levels, for templates served from the compiled index
+        self._scaled = {}    # name -> pyramid levels of its copy scaled by TEMPLATE_INDEX.scale
+        self._current = TemplateSet({}, 0)
+        self._checked_at = None
+        self.hits = 0
+        self.misses = 0
+        self.indexed = 0
+        self.reloads = 0
+        self.last_reload = None
+
+    def _read_generation(self):
+        try:
+            st = os.stat(self.generation_path)
+        except OSError:
+            return None
+        return st.st_mtime_ns, st.st_size
+
+    def get(self):
+        with self._lock:
+            now = time.monotonic()
+            generation = self._read_generation()
+            if generation != self._generation:
+                self._generation = generation
+                self._scan(force=True)
+                self._checked_at = now
+                return self._current
+            if self._checked_at is not None and now - self._checked_at < self.check_seconds:
+                self.hits += 1
+                return self._current
+            if not self._scan(force=False):
+                self.hits += 1
+            self._checked_at = now
+            return self._current
+
+    def reload(self):
+        with self._lock:
+            self._scan(force=True)
+            self._checked_at = time.monotonic()
+            if os.path.isdir(self.template_dir):
+                write_atomic(self.generation_path, uuid.uuid4().hex.encode("ascii"))
+                self._generation = self._read_generation()
+            return self._current
+
+    def _scan(self, force):
+        # re-decode only files whose mtime/size changed; returns True if the set changed
+        entries = {}
+        if os.path.isdir(self.template_dir):
+            for entry in os.scandir(self.template_dir):
+                if entry.is_file() and entry.name.lower().endswith(TEMPLATE_EXTS):
+                    st = entry.stat()
+                    entries[entry.name] = (st.st_mtime_ns, st.st_size)
+
+        changed = force or set(entries) != set(self._files)
+        files = {}
+        for filename in sorted(entries):
+            mtime, size = entries[filename]
+            cached = self._files.get(filename)
+            if not force and cached is not None and cached[:2] == (mtime, size):
+                files[filename] = cached
                 continue
-            status = "✔" if info["detected"] else "✘"
-            rows += "<tr><td>{}</td><td>{}</td><td>{:.2f}</td><td>{}</td></tr>".format(
-                device, status, info["score"], info["template"]
-            )
+            changed = True
+            self.misses += 1
+            name = os.path.splitext(filename)[0]
+            found = TEMPLATE_INDEX.lookup(self.template_dir, filename, mtime, size) if TEMPLATE_INDEX else None
+            if found is not None:
+                self.indexed += 1
+                levels, scaled = found
+                self._pyramids[name] = levels
+                if scaled:
+                    self._scaled[name] = scaled
+                else:
+                    self._scaled.pop(name, None)
+                files[filename] = (mtime, size, name, levels[0])
+                continue
+            self._pyramids.pop(name, None)
+            self._scaled.pop(name, None)
+            img = cv2.imread(os.path.join(self.template_dir, filename), cv2.IMREAD_GRAYSCALE)
+            if img is not None:
+                files[filename] = (mtime, size, name, img)
 
-        if rows.strip() == "":
-            rows = "<tr><td colspan='4' style='padding:8px'>無高相似度結果</td></tr>"
+        if not changed:
+            return False
+        self._files = files
+        templates = {name: img for _, _, name, img in files.values()}
+        self._pyramids = {name: levels for name, levels in self._pyramids.items() if name in templates}
+        self._scaled = {name: levels for name, levels in self._scaled.items() if name in templates}
+        signature = hashlib.sha1(json.dumps(
+            [[filename, files[filename][0], files[filename][1]] for filename in sorted(files)]
+        ).encode("utf-8")).hexdigest()[:12]
+        self._current = TemplateSet(templates, self._current.version + 1, signature)
+        if (TEMPLATE_INDEX and TEMPLATE_INDEX.pyramid_params == [PYRAMID_LEVELS, PYRAMID_MIN_SIZE]
+                and all(name in self._pyramids for name in templates)):
+            # precomputed pyramid levels from the index, so the pyramid engine starts warm
+            pyramids = {name: self._pyramids[name] for name in templates}
+            self._current.derived(("pyramid", PYRAMID_LEVELS), lambda ts: pyramids)
+            scale = TEMPLATE_INDEX.scale
+            if scale and scale == served_scale(self._current) and all(name in self._scaled for name in templates):
+                # the scaled copy working_templates() would build, straight from the index as well
+                scaled = TemplateSet({name: self._scaled[name][0] for name in templates}, self._current.version)
+                scaled_pyramids = {name: self._scaled[name] for name in templates}
+                scaled.derived(("pyramid", PYRAMID_LEVELS), lambda ts: scaled_pyramids)
+                self._current.derived(("scaled", scale), lambda ts: scaled)
+        self.reloads += 1
+        self.last_reload = datetime.utcnow().isoformat()
+        return True
 
-        card_html += """
-        <div style="background:#fff; padding:14px; border-radius:10px; margin-bottom:18px;">
-          <h3>📸 圖片 {} : {}</h3>
-          <div style="text-align:center;">{}</div>
-          <table style="width:100%; margin-top:10px; border-collapse:collapse;">
-            <thead><tr style="background:#eef3ff"><th>設備</th><th>結果</th><th>相似度</th><th>模板</th></tr></thead>
-            <tbody>{}</tbody>
-          </table>
-        </div>
-        """.format(idx, file.filename, preview, rows)
+    def stats(self):
+        current = self._current
+        return {
+            "version": current.version,
+            "signature": current.signature,
+            "pid": os.getpid(),
+            "templates": len(current.templates),
+            "devices": len(current.devices),
+            "hits": self.hits,
+            "misses": self.misses,
+            "indexed": self.indexed,
+            "reloads": self.reloads,
+            "last_reload": self.last_reload,
+        }
 
-        all_results[file.filename] = device_res
 
-    save_record(division, user, vehicle_type, vehicle_id, all_results)
+TEMPLATE_STORE = TemplateStore(TEMPLATE_DIR)
 
-    page = """
-    <html>
-      <head>
-        <meta name="viewport" content="width=device-width, initial-scale=1">
-        <title>檢測結果</title>
-        <style>
-          body{font-family:Arial; background:#f4f7fb; padding:18px}
-          .container{max-width:900px; margin:0 auto}
-          a.btn{background:#1e88ff; color:#fff; padding:10px 14px; border-radius:8px; text-decoration:none}
-        </style>
-      </head>
-      <body>
-        <div class="container">
-          <div style="display:flex; justify-content:space-between; align-items:center;">
-            <h2>🔎 檢測結果總覽</h2>
-            <a href="/upload_form" class="btn">返回</a>
-          </div>
-          """ + card_html + """
-        </div>
-      </body>
-    </html>
-    """
 
-    return HTMLResponse(page)
+# ---------- equipment manifests ----------
+class ManifestStore:
+    # {"vehicle_types": {"救護車": [devices]}, "vehicles": {"A1-1": [devices]}}, reloaded when the file changes
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._mtime = None
+        self._data = {}
 
+    def get(self):
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except OSError:
+            return {}
+        with self._lock:
+            if mtime != self._mtime:
+                try:
+                    with open(self.path, encoding="utf-8") as f:
+                        self._data = json.load(f)
+                except (OSError, ValueError):
+                    log.exception("could not read %s, keeping the previous manifest", self.path)
+                self._mtime = mtime
+            return self._data
 
-@app.get("/records", response_class=HTMLResponse)
-async def records_page(request: Request):
-    if not request.session.get("user"):
-        return RedirectResponse(url="/")
+    def devices_for(self, vehicle_type, vehicle_id):
+        # a specific vehicle overrides its type; None means no manifest, match everything
+        data = self.get()
+        devices = data.get("vehicles", {}).get(vehicle_id)
+        if devices is None:
+            devices = data.get("vehicle_types", {}).get(vehicle_type)
+        return devices
 
-    rows = get_recent_records(60)
 
-    body = ""
-    for r in rows:
-        rid, ts, div, user, vtype, vid, data = r
-        body += "<tr><td>{}</td><td>{}</td><td>{}</td><td>{}</td><td>{}</td><td>{}</td></tr>".format(
-            rid, ts, div, user, vtype, vid
-        )
+MANIFESTS = ManifestStore(MANIFEST_PATH)
+
+
+def missing_devices(expected, all_results):
+    found = {device for device_res in all_results.values()
+             for device, info in device_res.items() if info["detected"]}
+    return [device for device in expected if device not in found]
+
+
+# ---------- helper functions ----------
+def write_atomic(path, data):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp = "{}.{}.tmp".format(path, uuid.uuid4().hex)
+    with open(tmp, "wb") as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+
+# ---------- previews ----------
+PREVIEW_ID = re.compile(r"[0-9a-f]{32}")
+
+
+def preview_path(pid, size="full"):
+    suffix = "" if size == "full" else "_" + size
+    return os.path.join(PREVIEW_DIR, pid[:2], pid + suffix + ".jpg")
+
+
+def store_preview(img_bgr):
+    # previews are content-addressed, so their URLs never change and can be cached forever
+    success, encoded = cv2.imencode(".jpg", img_bgr, [cv2.IMWRITE_JPEG_QUALITY, PREVIEW_QUALITY])
+    if not success:
+        return None
+    data = encoded.tobytes()
+    pid = hashlib.sha256(data).hexdigest()[:32]
+    if not touch_preview(pid):
+        write_atomic(preview_path(pid), data)
+    return pid
+
+
+def touch_preview(pid):
+    # a reused preview counts as new for the retention sweep; False if it is gone
+    try:
+        os.utime(preview_path(pid))
+        return True
+    except OSError:
+        return False
+
+
+class PreviewSweeper:
+    # deletes previews (and their thumbnails) older than PREVIEW_RETENTION_DAYS, at most once per
+    # PREVIEW_SWEEP_SECONDS per serving process, on a background thread so no request waits for it
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._last = None
+        self._running = False
+        self.sweeps = 0
+        self.deleted = 0
+
+    def maybe_sweep(self):
+        if not PREVIEW_RETENTION_DAYS:
+            return
+        with self._lock:
+            if self._running or (self._last is not None and time.monotonic() - self._last < PREVIEW_SWEEP_SECONDS):
+                return
+            self._running = True
+            self._last = time.monotonic()
+        threading.Thread(target=self.sweep, name="preview-sweep", daemon=True).start()
+
+    def sweep(self):
+        cutoff = time.time() - PREVIEW_RETENTION_DAYS * 86400
+        try:
+            if not os.path.isdir(PREVIEW_DIR):
+                return
+            for folder in os.scandir(PREVIEW_DIR):
+                if not folder.is_dir():
+                    continue
+                for entry in os.scandir(folder.path):
+                    try:
+                        if entry.stat().st_mtime < cutoff:
+                            os.remove(entry.path)
+                            self.deleted += 1
+                    except OSError:
+                        pass
+            self.sweeps += 1
+        except Exception:
+            log.exception("preview sweep failed")
+        finally:
+            with self._lock:
+                self._running = False
+
+    def stats(self):
+        return {"retention_days": PREVIEW_RETENTION_DAYS, "sweeps": self.sweeps, "deleted": self.deleted}
+
+
+PREVIEW_SWEEPER = PreviewSweeper()
+
+
+def preview_file(pid, size):
+    path = preview_path(pid, size)
+    if os.path.exists(path):
+        return path
+    full = preview_path(pid)
+    if size == "full" or not os.path.exists(full):
+        return None
+    img = cv2.imread(full)
+    if img is None:
+        return None
+    scale = PREVIEW_SIZES[size] / max(img.shape[:2])
+    if scale < 1:
+        img = cv2.resize(img, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+    success, encoded = cv2.imencode(".jpg", img, [cv2.IMWRITE_JPEG_QUALITY, PREVIEW_QUALITY])
+    if not success:
+        return None
+    write_atomic(path, encoded.tobytes())
+    return path
+
+
+# ---------- image pre-processing ----------
+JPEG_HEADER_BYTES = 1 << 17
+JPEG_SOF_MARKERS = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+REDUCED_FLAGS = {2: cv2.IMREAD_REDUCED_COLOR_2, 4: cv2.IMREAD_REDUCED_COLOR_4, 8: cv2.IMREAD_REDUCED_COLOR_8}
+
+
+def exif_orientation(tiff):
+    endian = {b"II": "little", b"MM": "big"}.get(tiff[:2])
+    if endian is None or len(tiff) < 8:
+        return None
+    ifd = int.from_bytes(tiff[4:8], endian)
+    count = int.from_bytes(tiff[ifd:ifd + 2], endian)
+    for i in range(count):
+        entry = ifd + 2 + i * 12
+        if int.from_bytes(tiff[entry:entry + 2], endian) == 0x0112:
+            return int.from_bytes(tiff[entry + 8:entry + 10], endian)
+    return None
+
+
+def jpeg_info(data):
+    # (width, height, exif orientation) read from the JPEG header, None if not a JPEG
+    if data[:2] != b"\xff\xd8":
+        return None
+    pos = 2
+    orientation = 1
+    while pos + 4 <= len(data):
+        if data[pos] != 0xFF:
+            return None
+        marker = data[pos + 1]
+        if marker == 0xFF:
+            pos += 1
+            continue
+        if marker == 0x01 or 0xD0 <= marker <= 0xD8:
+            pos += 2
+            continue
+        length = int.from_bytes(data[pos + 2:pos + 4], "big")
+        segment = data[pos + 4:pos + 2 + length]
+        if marker == 0xE1 and segment[:6] == b"Exif\0\0":
+            orientation = exif_orientation(segment[6:]) or 1
+        elif marker in JPEG_SOF_MARKERS:
+            height = int.from_bytes(segment[1:3], "big")
+            width = int.from_bytes(segment[3:5], "big")
+            return width, height, orientation
+        pos += 2 + length
+    return None
+
+
+def apply_orientation(img, orientation):
+    if orientation == 2:
+        return cv2.flip(img, 1)
+    if orientation == 3:
+        return cv2.rotate(img, cv2.ROTATE_180)
+    if orientation == 4:
+        return cv2.flip(img, 0)
+    if orientation == 5:
+        return cv2.transpose(img)
+    if orientation == 6:
+        return cv2.rotate(img, cv2.ROTATE_90_CLOCKWISE)
+    if orientation == 7:
+        return cv2.flip(cv2.transpose(img), -1)
+    if orientation == 8:
+        return cv2.rotate(img, cv2.ROTATE_90_COUNTERCLOCKWISE)
+    return img
+
+
+def load_image(data):
+    # decode the upload bytes, rotate upright once, and resize to the working resolution
+    info = jpeg_info(data[:JPEG_HEADER_BYTES])
+
+    flags = cv2.IMREAD_COLOR
+    orientation = None
+    if info is not None:
+        width, height, orientation = info
+        flags |= cv2.IMREAD_IGNORE_ORIENTATION
+        if WORK_MAX_SIDE:
+            # let libjpeg drop resolution while decoding (DCT scaling)
+            for factor in (8, 4, 2):
+                if max(width, height) // factor >= WORK_MAX_SIDE:
+                    flags = REDUCED_FLAGS[factor] | cv2.IMREAD_IGNORE_ORIENTATION
+                    break
+
+    img = cv2.imdecode(np.frombuffer(data, np.uint8), flags)
+    if img is None:
+        return None
+    if orientation is not None:
+        img = apply_orientation(img, orientation)
+
+    if WORK_MAX_SIDE and max(img.shape[:2]) != WORK_MAX_SIDE:
+        scale = WORK_MAX_SIDE / max(img.shape[:2])
+        interp = cv2.INTER_AREA if scale < 1 else cv2.INTER_LINEAR
+        img = cv2.resize(img, None, fx=scale, fy=scale, interpolation=interp)
+    return img
+
+
+def scale_templates(template_set, scale):
+    interp = cv2.INTER_AREA if scale < 1 else cv2.INTER_LINEAR
+    templates = {}
+    for tname, tmpl in template_set.templates.items():
+        h, w = tmpl.shape
+        size = (max(1, round(w * scale)), max(1, round(h * scale)))
+        templates[tname] = cv2.resize(tmpl, size, interpolation=interp)
+    return TemplateSet(templates, template_set.version)
+
+
+def working_templates(template_set, photo_scale=1.0):
+    # templates resized once per version to match photos at WORK_MAX_SIDE, or, at full size, photos
+    # the upload form shrank by photo_scale
+    if WORK_MAX_SIDE:
+        scale = WORK_MAX_SIDE / TEMPLATE_REF_SIDE
+    else:
+        scale = photo_scale
+    if scale == 1:
+        return template_set
+    return template_set.derived(("scaled", scale), lambda ts: scale_templates(ts, scale))
+
+
+def client_scale(template_set):
+    # how far the upload form shrinks full-size photos: until the smallest template would drop below
+    # CLIENT_MIN_TEMPLATE_SIDE, rounded up to 0.01. with WORK_MAX_SIDE the form uses max_side instead
+    sides = [min(tmpl.shape) for tmpl in template_set.templates.values()]
+    if WORK_MAX_SIDE or not sides:
+        return 1.0
+    return min(1.0, math.ceil(100 * CLIENT_MIN_TEMPLATE_SIDE / min(sides)) / 100)
+
+
+def served_scale(template_set):
+    # the scaled template set photos from the upload form are matched against; built into templates.idx
+    return WORK_MAX_SIDE / TEMPLATE_REF_SIDE if WORK_MAX_SIDE else client_scale(template_set)
+
+
+def photo_scales(values, count):
+    # factor the upload form shrank each photo by. only the advertised client_scale is accepted, so
+    # clients cannot make the server build a scaled template set per value; anything else counts as 1
+    advertised = client_scale(TEMPLATE_STORE.get())
+    scales = []
+    for idx in range(count):
+        try:
+            scale = round(float(values[idx]), 2)
+        except (IndexError, TypeError, ValueError):
+            scale = 1.0
+        scales.append(scale if scale == advertised else 1.0)
+    return scales
+
+
+# ---------- detection ----------
+def match_one(gray, tmpl):
+    try:
+        if tmpl.shape[0] > gray.shape[0] or tmpl.shape[1] > gray.shape[1]:
+            return None
+        res = cv2.matchTemplate(gray, tmpl, cv2.TM_CCOEFF_NORMED)
+        _, maxv, _, maxloc = cv2.minMaxLoc(res)
+        return maxv, maxloc
+    except:
+        return None
+
+
+class ParityStats:
+    # score agreement between a fast engine and the exhaustive search
+    def __init__(self, tolerance=None):
+        self.tolerance = tolerance
+        self._lock = threading.Lock()
+        self.count = 0
+        self.total_delta = 0.0
+        self.max_delta = 0.0
+        self.flips = 0
+        self.over_tolerance = 0
+
+    def record(self, exact, fast):
+        delta = abs(exact - fast)
+        with self._lock:
+            self.count += 1
+            self.total_delta += delta
+            self.max_delta = max(self.max_delta, delta)
+            if (exact >= THRESHOLD) != (fast >= THRESHOLD):
+                self.flips += 1
+            if self.tolerance is not None and delta > self.tolerance:
+                self.over_tolerance += 1
+
+    def stats(self):
+        stats = {
+            "compared": self.count,
+            "mean_delta": self.total_delta / self.count if self.count else 0.0,
+            "max_delta": self.max_delta,
+            "threshold_flips": self.flips,
+        }
+        if self.tolerance is not None:
+            stats["tolerance"] = self.tolerance
+            stats["over_tolerance"] = self.over_tolerance
+        return stats
+
+
+PYRAMID_PARITY = ParityStats()
+
+
+def build_pyramid(img, levels):
+    pyramid = [img]
+    for _ in range(levels):
+        pyramid.append(cv2.pyrDown(pyramid[-1]))
+    return pyramid
+
+
+def build_template_pyramids(template_set):
+    pyramids = {}
+    for tname, tmpl in template_set.templates.items():
+        levels = 0
+        while levels < PYRAMID_LEVELS and min(tmpl.shape) >> (levels + 1) >= PYRAMID_MIN_SIZE:
+            levels += 1
+        pyramids[tname] = build_pyramid(tmpl, levels)
+    return pyramids
+
+
+def top_peaks(res, k, h, w):
+    # best k maxima, suppressing a template-sized neighbourhood around each one
+    res = res.copy()
+    peaks = []
+    for _ in range(k):
+        _, maxv, _, maxloc = cv2.minMaxLoc(res)
+        if maxv <= -1:
+            break
+        peaks.append(maxloc)
+        x, y = maxloc
+        res[max(0, y - h // 2):y + h // 2 + 1, max(0, x - w // 2):x + w // 2 + 1] = -1
+    return peaks
+
+
+def match_pyramid(image_pyramid, tmpl_pyramid, parity=None):
+    # with PYRAMID_VERIFY, (exact, pyramid) score pairs go to parity for the caller to record
+    gray, tmpl = image_pyramid[0], tmpl_pyramid[0]
+    level = min(len(tmpl_pyramid), len(image_pyramid)) - 1
+    if level == 0:
+        return match_one(gray, tmpl)
+    small, small_tmpl = image_pyramid[level], tmpl_pyramid[level]
+    try:
+        if small_tmpl.shape[0] > small.shape[0] or small_tmpl.shape[1] > small.shape[1]:
+            return None
+        coarse = cv2.matchTemplate(small, small_tmpl, cv2.TM_CCOEFF_NORMED)
+    except:
+        return None
+
+    factor = 1 << level
+    th, tw = tmpl.shape
+    best = None
+    for cx, cy in top_peaks(coarse, PYRAMID_TOP_K, *small_tmpl.shape):
+        # refine inside the candidate window, padded by two coarse pixels
+        x0 = max(0, (cx - 2) * factor)
+        y0 = max(0, (cy - 2) * factor)
+        x1 = min(gray.shape[1], (cx + 2) * factor + tw)
+        y1 = min(gray.shape[0], (cy + 2) * factor + th)
+        found = match_one(gray[y0:y1, x0:x1], tmpl)
+        if found is None:
+            continue
+        maxv, (x, y) = found
+        if best is None or maxv > best[0]:
+            best = (maxv, (x0 + x, y0 + y))
+
+    if PYRAMID_VERIFY and parity is not None:
+        exact = match_one(gray, tmpl)
+        if exact is not None:
+            parity.append((exact[0], best[0] if best else -1))
+    return best
+
+
+FFT_PARITY = ParityStats(FFT_TOLERANCE)
+
+
+class FFTMatcher:
+    # TM_CCOEFF_NORMED from DFTs; template statistics are computed once per template version
+    # and template spectra once per image size, so a request only transforms the photo
+    def __init__(self, template_set):
+        self.originals = template_set.templates
+        self.templates = {}
+        for tname, tmpl in template_set.templates.items():
+            zero_mean = tmpl.astype(np.float32) - np.float32(tmpl.mean())
+            norm = float(np.sqrt(np.square(zero_mean, dtype=np.float64).sum()))
+            self.templates[tname] = (zero_mean, norm)
+        self._spectra = OrderedDict()   # dft size -> {template name: spectrum}
+        self._lock = threading.Lock()
+
+    def spectra(self, size):
+        with self._lock:
+            cached = self._spectra.get(size)
+            if cached is not None:
+                self._spectra.move_to_end(size)
+                return cached
+        cached = {}
+        for tname, (zero_mean, _) in self.templates.items():
+            h, w = zero_mean.shape
+            if h > size[0] or w > size[1]:
+                continue
+            padded = np.zeros(size, np.float32)
+            padded[:h, :w] = zero_mean
+            cached[tname] = cv2.dft(padded)
+        with self._lock:
+            self._spectra[size] = cached
+            while len(self._spectra) > FFT_CACHE_SHAPES:
+                self._spectra.popitem(last=False)
+        return cached
+
+
+class FFTImage:
+    # per-photo state shared by every template: one forward DFT and one pair of integral images.
+    # with FFT_VERIFY, (exact, fft) score pairs go to parity for the caller to record
+    def __init__(self, gray, matcher, parity=None):
+        self.gray = gray
+        self.matcher = matcher
+        self.parity = parity
+        height, width = gray.shape
+        size = (cv2.getOptimalDFTSize(height), cv2.getOptimalDFTSize(width))
+        padded = np.zeros(size, np.float32)
+        padded[:height, :width] = gray
+        self.spectrum = cv2.dft(padded)
+        self.spectra = matcher.spectra(size)
+        self.sums, self.sqsums = cv2.integral2(gray, sdepth=cv2.CV_64F, sqdepth=cv2.CV_64F)
+        self._std = {}
+        self._lock = threading.Lock()
+
+    def window_std(self, h, w):
+        # sqrt of the window variance (times h*w), shared by all templates of the same size
+        with self._lock:
+            std = self._std.get((h, w))
+        if std is None:
+            s, q = self.sums, self.sqsums
+            sums = s[h:, w:] - s[:-h, w:] - s[h:, :-w] + s[:-h, :-w]
+            sqsums = q[h:, w:] - q[:-h, w:] - q[h:, :-w] + q[:-h, :-w]
+            sqsums -= sums * sums / (h * w)
+            std = np.sqrt(np.maximum(sqsums, 0)).astype(np.float32)
+            # flat windows: rounding noise must not turn into huge scores
+            std[std < 1e-2] = 0
+            with self._lock:
+                std = self._std.setdefault((h, w), std)
+        return std
+
+    def match(self, tname):
+        zero_mean, norm = self.matcher.templates[tname]
+        h, w = zero_mean.shape
+        height, width = self.gray.shape
+        if h > height or w > width:
+            return None
+        if norm < 1e-6:
+            # cv2 scores a constant template as 1 everywhere
+            maxv, maxloc = 1.0, (0, 0)
+        else:
+            rows, cols = height - h + 1, width - w + 1
+            corr = cv2.idft(cv2.mulSpectrums(self.spectrum, self.spectra[tname], 0, conjB=True),
+                            flags=cv2.DFT_SCALE | cv2.DFT_REAL_OUTPUT, nonzeroRows=rows)[:rows, :cols]
+            # divide yields 0 where the window is flat
+            res = cv2.divide(corr, self.window_std(h, w), scale=1.0 / norm)
+            _, maxv, _, maxloc = cv2.minMaxLoc(res)
+            if maxv > 1:
+                # same clamping as cv2: rounding just above 1 snaps to 1, anything larger is noise
+                res[np.abs(res) > 1.125] = 0
+                np.clip(res, -1, 1, out=res)
+                _, maxv, _, maxloc = cv2.minMaxLoc(res)
+
+        if FFT_VERIFY and self.parity is not None:
+            exact = match_one(self.gray, self.matcher.originals[tname])
+            if exact is not None:
+                self.parity.append((exact[0], maxv))
+        return maxv, maxloc
+
+
+# ---------- ORB keypoint engine ----------
+def orb_detector(features):
+    return cv2.ORB_create(features, edgeThreshold=ORB_PATCH_SIZE, patchSize=ORB_PATCH_SIZE)
+
+
+class OrbIndex:
+    # ORB descriptors of every template in one array, searched with an in-memory LSH index.
+    # extraction is the slow part, so descriptors are saved under ORB_INDEX_DIR and reused by
+    # later runs and by process pool workers as long as the template content is the same
+    def __init__(self, names, shapes, devices, owners, points, descriptors):
+        self.names = names
+        self.shapes = shapes
+        self.devices = devices
+        self.owners = owners
+        self.points = points
+        self.descriptors = descriptors
+        self._lock = threading.Lock()
+        self._flann = None
+        if len(descriptors):
+            self._flann = cv2.flann_Index(descriptors, {"algorithm": 6, "table_number": 6, "key_size": 12,
+                                                        "multi_probe_level": 1})
+
+    @staticmethod
+    def signature(template_set):
+        digest = hashlib.sha1(repr((ORB_FEATURES, ORB_PATCH_SIZE)).encode())
+        for tname in sorted(template_set.templates):
+            tmpl = template_set.templates[tname]
+            digest.update("{}:{}".format(tname, tmpl.shape).encode())
+            digest.update(np.ascontiguousarray(tmpl).data)
+        return digest.hexdigest()
+
+    @classmethod
+    def for_templates(cls, template_set):
+        path = os.path.join(ORB_INDEX_DIR, cls.signature(template_set) + ".npz")
+        if os.path.exists(path):
+            try:
+                with np.load(path) as data:
+                    return cls(list(data["names"]), [tuple(s) for s in data["shapes"]], list(data["devices"]),
+                               data["owners"], data["points"], data["descriptors"])
+            except (OSError, ValueError, KeyError):
+                log.exception("could not read %s, rebuilding", path)
+        index = cls.build(template_set)
+        buf = io.BytesIO()
+        np.savez(buf, names=np.array(index.names), shapes=np.array(index.shapes, dtype=np.int32).reshape(-1, 2),
+                 devices=np.array(index.devices), owners=index.owners, points=index.points,
+                 descriptors=index.descriptors)
+        write_atomic(path, buf.getvalue())
+        return index
+
+    @classmethod
+    def build(cls, template_set):
+        orb = orb_detector(ORB_FEATURES)
+        names, shapes, owners, points, descriptors = [], [], [], [], []
+        for tname in sorted(template_set.templates):
+            tmpl = template_set.templates[tname]
+            keypoints, desc = orb.detectAndCompute(tmpl, None)
+            if desc is None:
+                log.warning("template %s has no ORB keypoints", tname)
+                continue
+            owners.append(np.full(len(keypoints), len(names), np.int32))
+            points.append(np.float32([kp.pt for kp in keypoints]))
+            descriptors.append(desc)
+            names.append(tname)
+            shapes.append(tmpl.shape)
+        devices = [tname.split("_")[0] for tname in names]
+        if not descriptors:
+            return cls(names, shapes, devices, np.zeros(0, np.int32), np.zeros((0, 2), np.float32),
+                       np.zeros((0, 32), np.uint8))
+        return cls(names, shapes, devices, np.concatenate(owners), np.concatenate(points),
+                   np.concatenate(descriptors))
+
+    def match(self, gray):
+        # one search of all photo keypoints against all templates, then a RANSAC homography per template;
+        # returns {tname: (score, top-left, (h, w))} for templates with a plausible placement
+        if self._flann is None:
+            return {}
+        keypoints, desc = orb_detector(ORB_PHOTO_FEATURES).detectAndCompute(gray, None)
+        if desc is None or len(keypoints) < 2:
+            return {}
+        with self._lock:
+            nearest, distance = self._flann.knnSearch(desc, 2, params={})
+        first, second = nearest[:, 0], nearest[:, 1]
+        valid = (first >= 0) & (first < len(self.owners))
+        second_ok = (second >= 0) & (second < len(self.owners))
+        owner_device = np.array(self.devices)[self.owners]
+        # the ratio test only counts a runner-up from another device; sibling templates often share keypoints
+        ambiguous = np.zeros(len(first), bool)
+        both = valid & second_ok
+        ambiguous[both] = ((owner_device[first[both]] != owner_device[second[both]])
+                           & (distance[both, 0] >= ORB_RATIO * distance[both, 1]))
+        good = np.nonzero(valid & ~ambiguous)[0]
+
+        photo_points = np.float32([kp.pt for kp in keypoints])
+        owners = self.owners[first[good]]
+        found = {}
+        for t in np.unique(owners):
+            picked = good[owners == t]
+            if len(picked) < ORB_MIN_MATCHES:
+                continue
+            src = self.points[first[picked]].reshape(-1, 1, 2)
+            dst = photo_points[picked].reshape(-1, 1, 2)
+            homography, mask = cv2.findHomography(src, dst, cv2.RANSAC, 5.0)
+            if homography is None:
+                continue
+            h, w = self.shapes[t]
+            corners = cv2.perspectiveTransform(np.float32([[0, 0], [w, 0], [w, h], [0, h]]).reshape(-1, 1, 2),
+                                               homography)
+            if not cv2.isContourConvex(corners.astype(np.int32)):
+                continue
+            x, y, bw, bh = cv2.boundingRect(corners.astype(np.int32))
+            score = min(1.0, int(mask.sum()) / float(ORB_FULL_INLIERS))
+            found[self.names[t]] = (score, (max(x, 0), max(y, 0)), (bh, bw))
+        return found
+
+
+def scan_orb(gray, template_set, device_templates, skip=()):
+    # same (score, loc, shape, tname) per device as the template scans; score is inliers / ORB_FULL_INLIERS
+    found = template_set.derived("orb", OrbIndex.for_templates).match(gray)
+    best = {}
+    for device, tlist in device_templates.items():
+        if PRESENCE_MODE and device in skip:
+            continue
+        best[device] = (0.0, None, None, None)
+        for tname, _ in tlist:
+            if tname in found and found[tname][0] > best[device][0]:
+                best[device] = found[tname] + (tname,)
+    return best
+
+
+_match_executor = None
+_match_executor_lock = threading.Lock()
+
+
+def match_executor():
+    # created lazily so forked process workers get their own threads
+    global _match_executor
+    if MATCH_WORKERS <= 0:
+        return None
+    with _match_executor_lock:
+        if _match_executor is None:
+            _match_executor = ThreadPoolExecutor(max_workers=MATCH_WORKERS,
+                                                 thread_name_prefix="match")
+        return _match_executor
+
+
+@read_op
+def template_hits(c):
+    return c.execute(
+        "SELECT template, COUNT(*) FROM detections WHERE detected = 1 AND template IS NOT NULL GROUP BY template"
+    ).fetchall()
+
+
+class TemplateHitRates:
+    # how often each template confirmed its device, seeded from the detections table
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._hits = None
+
+    def _load(self):
+        hits = {}
+        try:
+            hits.update(read("template_hits"))
+        except sqlite3.Error:
+            log.exception("could not read template hit rates")
+        return hits
+
+    def order(self, tlist):
+        with self._lock:
+            if self._hits is None:
+                self._hits = self._load()
+            hits = self._hits
+            return sorted(tlist, key=lambda item: -hits.get(item[0], 0))
+
+    def record(self, tname):
+        with self._lock:
+            if self._hits is not None:
+                self._hits[tname] = self._hits.get(tname, 0) + 1
+
+
+class PresenceStats:
+    # template matches avoided by presence mode, per device and overall
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.devices = {}
+
+    def record(self, device, run, skipped_templates=0, skipped_image=False):
+        with self._lock:
+            entry = self.devices.setdefault(device, {"matched": 0, "skipped_templates": 0, "skipped_images": 0})
+            entry["matched"] += run
+            entry["skipped_templates"] += skipped_templates
+            entry["skipped_images"] += int(skipped_image)
+
+    def stats(self):
+        with self._lock:
+            devices = {device: dict(entry) for device, entry in self.devices.items()}
+        matched = sum(entry["matched"] for entry in devices.values())
+        skipped = sum(entry["skipped_templates"] for entry in devices.values())
+        return {
+            "enabled": PRESENCE_MODE,
+            "matched": matched,
+            "skipped": skipped,
+            "saved_ratio": skipped / (matched + skipped) if matched + skipped else 0.0,
+            "devices": devices,
+        }
+
+
+class VariantStats:
+    # work done by the scale / rotation search, against trying every variant at full resolution
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.images = 0
+        self.totals = {"variants": 0, "probed": 0, "pruned": 0, "refined": 0, "improved": 0, "exhaustive": 0}
+
+    def record(self, cost):
+        with self._lock:
+            self.images += 1
+            for key in self.totals:
+                self.totals[key] += cost.get(key, 0)
+
+    def stats(self):
+        with self._lock:
+            totals = dict(self.totals)
+        return {
+            "scales": list(MATCH_SCALES),
+            "rotations": list(MATCH_ROTATIONS),
+            "images": self.images,
+            **totals,
+            "refined_ratio": totals["refined"] / totals["exhaustive"] if totals["exhaustive"] else 0.0,
+        }
+
+
+class RoiStats:
+    # how often the last known position was enough, per device searched there
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.images = 0
+        self.tried = 0
+        self.hits = 0
+        self.roi_pixels = 0
+        self.frame_pixels = 0
+
+    def record(self, roi):
+        with self._lock:
+            self.images += 1
+            self.tried += roi["tried"]
+            self.hits += roi["hits"]
+            self.roi_pixels += roi["roi_pixels"]
+            self.frame_pixels += roi["frame_pixels"]
+
+    def stats(self):
+        return {
+            "enabled": ROI_SEARCH,
+            "images": self.images,
+            "tried": self.tried,
+            "hits": self.hits,
+            "fallbacks": self.tried - self.hits,
+            "hit_rate": self.hits / self.tried if self.tried else 0.0,
+            "searched_area": self.roi_pixels / self.frame_pixels if self.frame_pixels else 0.0,
+        }
+
+
+TEMPLATE_HIT_RATES = TemplateHitRates()
+PRESENCE_STATS = PresenceStats()
+VARIANT_STATS = VariantStats()
+ROI_STATS = RoiStats()
+
+
+def make_matcher(gray, template_set, parity=None):
+    # returns match(tname, tmpl) -> (score, top-left) or None for the configured engine;
+    # parity ({engine: [(exact, fast), ...]}) collects the verify scores
+    parity = {} if parity is None else parity
+    if MATCH_ENGINE == "pyramid":
+        image_pyramid = build_pyramid(gray, PYRAMID_LEVELS)
+        tmpl_pyramids = template_set.derived(("pyramid", PYRAMID_LEVELS), build_template_pyramids)
+        pairs = parity.setdefault("pyramid", [])
+        return lambda tname, tmpl: match_pyramid(image_pyramid, tmpl_pyramids[tname], pairs)
+
+    if MATCH_ENGINE == "fft":
+        fft_image = FFTImage(gray, template_set.derived("fft", FFTMatcher), parity.setdefault("fft", []))
+
+        def match(tname, tmpl):
+            try:
+                return fft_image.match(tname)
+            except:
+                return None
+        return match
+
+    return lambda tname, tmpl: match_one(gray, tmpl)
+
+
+def run_jobs(fn, jobs):
+    executor = match_executor()
+    if executor is None or len(jobs) < 2:
+        return [fn(job) for job in jobs]
+    return list(executor.map(fn, jobs))
+
+
+def scan_all(match, device_templates):
+    jobs = [(device, tname, tmpl)
+            for device, tlist in device_templates.items()
+            for tname, tmpl in tlist]
+    found = run_jobs(lambda job: match(job[1], job[2]), jobs)
+
+    # reduce in template order so ties resolve exactly like a sequential scan
+    best = {device: (-1, None, None, None) for device in device_templates}
+    for (device, tname, tmpl), result in zip(jobs, found):
+        if result is None:
+            continue
+        maxv, maxloc = result
+        if maxv > best[device][0]:
+            best[device] = (maxv, maxloc, tmpl.shape, tname)
+    return best
+
+
+def scan_presence(match, device_templates, skip, presence):
+    # one job per device; templates run best-hit-rate first and stop at the first confident hit.
+    # presence collects PresenceStats.record arguments, recorded by the caller (this may be a pool process)
+    def scan_device(item):
+        device, tlist = item
+        best = (-1, None, None, None)
+        run = 0
+        for tname, tmpl in TEMPLATE_HIT_RATES.order(tlist):
+            result = match(tname, tmpl)
+            run += 1
+            if result is None:
+                continue
+            maxv, maxloc = result
+            if maxv > best[0]:
+                best = (maxv, maxloc, tmpl.shape, tname)
+            if maxv >= THRESHOLD + PRESENCE_MARGIN:
+                break
+        presence.append((device, run, len(tlist) - run, False))
+        return best
+
+    todo = []
+    for device, tlist in device_templates.items():
+        if device in skip:
+            # already confirmed in an earlier photo of this upload
+            presence.append((device, 0, len(tlist), True))
+        else:
+            todo.append((device, tlist))
+    return dict(zip([device for device, _ in todo], run_jobs(scan_device, todo)))
+
+
+# ---------- scale / rotation variants ----------
+def match_variants():
+    return [(scale, angle) for scale in MATCH_SCALES for angle in MATCH_ROTATIONS if (scale, angle) != (1.0, 0)]
+
+
+def variant_transform(shape, scale, angle):
+    # affine map from the photo to its variant where a template `scale` times larger and tilted by
+    # `angle` degrees lines up with the stored template; the canvas grows to keep the whole photo
+    h, w = shape
+    forward = cv2.getRotationMatrix2D((w / 2, h / 2), -angle, 1 / scale)
+    cos, sin = abs(forward[0, 0]), abs(forward[0, 1])
+    nw, nh = int(round(h * sin + w * cos)), int(round(h * cos + w * sin))
+    forward[0, 2] += nw / 2 - w / 2
+    forward[1, 2] += nh / 2 - h / 2
+    return forward, (nh, nw)
+
+
+def warp_region(img, forward, x0, y0, width, height, level=0):
+    # part of the variant starting at (x0, y0), rendered from a photo pyramid level
+    m = forward.copy()
+    m[:, 2] /= 1 << level
+    m[0, 2] -= x0
+    m[1, 2] -= y0
+    return cv2.warpAffine(img, m, (width, height), flags=cv2.INTER_LINEAR, borderMode=cv2.BORDER_REPLICATE)
+
+
+def scan_variants(gray, template_set, device_templates, best, cost):
+    # improves the plain scan in `best` with scaled / rotated variants of the photo.
+    # every template is probed on every variant at its coarsest pyramid level, pairs that cannot beat
+    # max(THRESHOLD, best so far) are dropped, and the MATCH_REFINE_TOP best variants per template are
+    # matched again at full resolution, only inside windows around the coarse peaks
+    variants = match_variants()
+    tmpl_pyramids = template_set.derived(("pyramid", PYRAMID_LEVELS), build_template_pyramids)
+    jobs = [(device, tname, tmpl)
+            for device, tlist in device_templates.items() if device in best
+            for tname, tmpl in tlist]
+    if PRESENCE_MODE:
+        jobs = [job for job in jobs if best[job[0]][0] < THRESHOLD + PRESENCE_MARGIN]
+    cost.update(variants=len(variants), exhaustive=len(variants) * len(jobs))
+    if not jobs:
+        return best
+
+    # each variant is rendered once per pyramid level in use and shared by all templates
+    levels = sorted({len(tmpl_pyramids[tname]) - 1 for _, tname, _ in jobs})
+    photo_pyramid = build_pyramid(gray, levels[-1])
+    transforms = [variant_transform(gray.shape, *variant) for variant in variants]
+
+    def render(item):
+        vi, level = item
+        forward, (nh, nw) = transforms[vi]
+        return warp_region(photo_pyramid[level], forward, 0, 0, max(nw >> level, 1), max(nh >> level, 1), level)
+    renders = [(vi, level) for vi in range(len(variants)) for level in levels]
+    rendered = dict(zip(renders, run_jobs(render, renders)))
+
+    def probe(item):
+        vi, (device, tname, tmpl) = item
+        pyramid = tmpl_pyramids[tname]
+        level = len(pyramid) - 1
+        small, small_tmpl = rendered[(vi, level)], pyramid[level]
+        if small_tmpl.shape[0] > small.shape[0] or small_tmpl.shape[1] > small.shape[1]:
+            return None
+        res = cv2.matchTemplate(small, small_tmpl, cv2.TM_CCOEFF_NORMED)
+        return cv2.minMaxLoc(res)[1], level, top_peaks(res, PYRAMID_TOP_K, *small_tmpl.shape)
+    probes = [(vi, job) for vi in range(len(variants)) for job in jobs]
+    coarse = run_jobs(probe, probes)
+    cost["probed"] = len(probes)
+
+    candidates = {}
+    for (vi, job), result in zip(probes, coarse):
+        if result is None or result[0] < max(THRESHOLD, best[job[0]][0]) - MATCH_PRUNE_MARGIN:
+            continue
+        candidates.setdefault(job[1], []).append((result[0], vi, job, result[1], result[2]))
+    refine = []
+    for items in candidates.values():
+        items.sort(key=lambda item: -item[0])
+        refine += items[:MATCH_REFINE_TOP]
+    cost["refined"] = len(refine)
+    cost["pruned"] = len(probes) - len(refine)
+
+    def refine_one(item):
+        _, vi, (device, tname, tmpl), level, peaks = item
+        forward, (nh, nw) = transforms[vi]
+        th, tw = tmpl.shape
+        factor = 1 << level
+        found_best = None
+        for cx, cy in peaks:
+            # padded by two coarse pixels, like the pyramid engine
+            x0, y0 = max(0, (cx - 2) * factor), max(0, (cy - 2) * factor)
+            x1, y1 = min(nw, (cx + 2) * factor + tw), min(nh, (cy + 2) * factor + th)
+            found = match_one(warp_region(gray, forward, x0, y0, x1 - x0, y1 - y0), tmpl)
+            if found is not None and (found_best is None or found[0] > found_best[0]):
+                found_best = (found[0], (found[1][0] + x0, found[1][1] + y0))
+        return found_best
+    refined = run_jobs(refine_one, refine)
+
+    # same reduction order every time; the plain scan wins ties
+    for (_, vi, (device, tname, tmpl), _, _), result in zip(refine, refined):
+        if result is None or result[0] <= best[device][0]:
+            continue
+        maxv, (x, y) = result
+        scale = variants[vi][0]
+        back = cv2.invertAffineTransform(transforms[vi][0])
+        th, tw = tmpl.shape
+        cx, cy = x + tw / 2, y + th / 2
+        ox = back[0, 0] * cx + back[0, 1] * cy + back[0, 2]
+        oy = back[1, 0] * cx + back[1, 1] * cy + back[1, 2]
+        oh, ow = int(round(th * scale)), int(round(tw * scale))
+        best[device] = (maxv, (max(int(round(ox - ow / 2)), 0), max(int(round(oy - oh / 2)), 0)), (oh, ow), tname)
+        cost["improved"] = cost.get("improved", 0) + 1
+    return best
+
+
+# ---------- last known positions ----------
+def roi_window(box, shape, tmpl_shape):
+    # padded box in pixels, grown if needed so the template (maybe larger than last time's) fits
+    height, width = shape
+    th, tw = tmpl_shape
+    bx, by, bw, bh = box
+    x0, x1 = (bx - bw * ROI_PADDING) * width, (bx + bw * (1 + ROI_PADDING)) * width
+    y0, y1 = (by - bh * ROI_PADDING) * height, (by + bh * (1 + ROI_PADDING)) * height
+    grow_x, grow_y = max(0, tw - (x1 - x0)) / 2, max(0, th - (y1 - y0)) / 2
+    x0, x1 = max(0, int(x0 - grow_x)), min(width, int(np.ceil(x1 + grow_x)))
+    y0, y1 = max(0, int(y0 - grow_y)), min(height, int(np.ceil(y1 + grow_y)))
+    return x0, y0, x1, y1
+
+
+def scan_rois(gray, device_templates, rois, roi):
+    # every template of a device is matched inside the padded boxes where the vehicle last had it;
+    # devices scoring THRESHOLD there are done, the others fall back to the full-frame search
+    jobs = [(device, tname, tmpl, roi_window(box, gray.shape, tmpl.shape))
+            for device, tlist in device_templates.items() if device in rois
+            for box in rois[device]
+            for tname, tmpl in tlist]
+
+    def match_roi(job):
+        _, _, tmpl, (x0, y0, x1, y1) = job
+        found = match_one(gray[y0:y1, x0:x1], tmpl)
+        if found is None:
+            return None
+        return found[0], (found[1][0] + x0, found[1][1] + y0)
+    found = run_jobs(match_roi, jobs)
+
+    best = {}
+    for (device, tname, tmpl, _), result in zip(jobs, found):
+        if result is not None and result[0] > best.get(device, (-1,))[0]:
+            best[device] = (result[0], result[1], tmpl.shape, tname)
+    hits = {device: entry for device, entry in best.items() if entry[0] >= THRESHOLD}
+    roi.update(tried=len({job[0] for job in jobs}), hits=len(hits),
+               roi_pixels=sum((x1 - x0) * (y1 - y0) for _, _, _, (x0, y0, x1, y1) in jobs),
+               frame_pixels=gray.size * len(jobs))
+    return hits
+
+
+def detect_image(gray, template_set, skip=(), devices=None, timings=None, cost=None, rois=None, roi=None,
+                 presence=None, parity=None):
+    # rois: last known boxes per device (see last_positions); roi collects how the ROI search went;
+    # presence collects what presence mode skipped, parity the verify scores of the fast engines
+    match = make_matcher(gray, template_set, parity)
+    if timings is not None:
+        # per-template durations; list.append is safe from the match threads
+        template_times = timings.setdefault("templates", [])
+        untimed = match
+
+        def match(tname, tmpl):
+            started = time.perf_counter()
+            try:
+                return untimed(tname, tmpl)
+            finally:
+                template_times.append((tname, time.perf_counter() - started))
+    device_templates = template_set.devices
+    if devices is not None:
+        device_templates = {device: tlist for device, tlist in device_templates.items() if device in devices}
+    roi_hits = {}
+    if rois and MATCH_ENGINE != "orb":
+        searchable = {device: tlist for device, tlist in device_templates.items() if device not in skip}
+        roi_hits = scan_rois(gray, searchable, rois, {} if roi is None else roi)
+        device_templates = {device: tlist for device, tlist in device_templates.items() if device not in roi_hits}
+    if MATCH_ENGINE == "orb":
+        best = scan_orb(gray, template_set, device_templates, skip)
+    elif PRESENCE_MODE:
+        best = scan_presence(match, device_templates, skip, [] if presence is None else presence)
+    else:
+        best = scan_all(match, device_templates)
+    if match_variants() and MATCH_ENGINE != "orb":
+        best = scan_variants(gray, template_set, device_templates, best, {} if cost is None else cost)
+    best.update(roi_hits)
+
+    device_res = {}
+    best_boxes = {}
+
+    height, width = gray.shape
+    for device, (best_score, best_loc, best_shape, best_tname) in best.items():
+        device_res[device] = {
+            "score": best_score,
+            "detected": best_score >= THRESHOLD,
+            "template": best_tname
+        }
+
+        if best_score >= THRESHOLD and best_loc and best_shape:
+            h, w = best_shape
+            best_boxes[device] = (best_loc, (best_loc[0] + w, best_loc[1] + h), best_score)
+            # fractions of the upright photo, so they hold at any working resolution
+            device_res[device]["box"] = [round(best_loc[0] / width, 4), round(best_loc[1] / height, 4),
+                                         round(w / width, 4), round(h / height, 4)]
+            TEMPLATE_HIT_RATES.record(best_tname)
+
+    return device_res, best_boxes
+
+
+def annotate(img, best_boxes):
+    out = img.copy()
+    for device, (tl, br, score) in best_boxes.items():
+        cv2.rectangle(out, tl, br, (255, 0, 0), 2)
+        label = "{} ({:.2f})".format(device, score)
+        cv2.putText(out, label, (tl[0], tl[1] - 6),
+                    cv2.FONT_HERSHEY_SIMPLEX, 0.6, (255,0,0), 2)
+    return out
+
+
+# ---------- duplicate photos ----------
+class ResultCache:
+    # detections of recent photos, keyed by content hash. only the identical file is answered from here:
+    # a near-identical photo may be a different vehicle or a compartment with one device taken out.
+    # entries belong to one template version and are dropped when templates change;
+    # process pool workers each keep their own cache
+    def __init__(self, size=RESULT_CACHE_SIZE):
+        self.size = size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.version = None
+        self.exact_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def _check_version(self, version):
+        if version != self.version:
+            if self._entries:
+                self.invalidations += 1
+            self._entries.clear()
+            self.version = version
+
+    def get(self, version, context, sha256):
+        if not self.size:
+            return None
+        with self._lock:
+            self._check_version(version)
+            key = (context, sha256)
+            if key not in self._entries:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.exact_hits += 1
+            return self._entries[key]
+
+    def put(self, version, context, sha256, result):
+        if not self.size:
+            return
+        with self._lock:
+            self._check_version(version)
+            self._entries[(context, sha256)] = result
+            self._entries.move_to_end((context, sha256))
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def stats(self):
+        return {
+            "size": len(self._entries),
+            "max_size": self.size,
+            "exact_hits": self.exact_hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+        }
+
+
+RESULT_CACHE = ResultCache()
+
+
+def inspect_image(data, skip=(), devices=None, rois=None, vehicle_id=None, scale=1.0):
+    # runs inside the detection pool; process workers use their own template store.
+    # returns (device_res, preview_id, photo) where photo holds the hashes and whether the cache answered
+    # stage timings travel back in photo["timings"], so they also work from process workers
+    timings = {} if METRICS_ENABLED else None
+    template_set = TEMPLATE_STORE.get()
+    # the same file sent for another vehicle is searched again, with that vehicle's devices and positions
+    context = (vehicle_id, frozenset(skip), None if devices is None else frozenset(devices), scale)
+    with stage_timer("hash", timings):
+        sha256 = hashlib.sha256(data).hexdigest()
+    cached = RESULT_CACHE.get(template_set.version, context, sha256)
+    if cached is not None and (cached[1] is None or touch_preview(cached[1])):
+        device_res, preview_id = cached
+        return device_res, preview_id, {"sha256": sha256, "cached": "exact", "timings": timings}
+
+    with stage_timer("decode", timings):
+        img = load_image(data)
+        if img is None:
+            return None
+        gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+
+    cost = {}
+    roi = {}
+    presence = []
+    parity = {}
+    with stage_timer("match", timings):
+        device_res, best_boxes = detect_image(gray, working_templates(template_set, scale), skip, devices, timings,
+                                              cost, rois, roi, presence, parity)
+    with stage_timer("annotate", timings):
+        annotated = annotate(img, best_boxes)
+    with stage_timer("preview", timings):
+        preview_id = store_preview(annotated)
+    RESULT_CACHE.put(template_set.version, context, sha256, (device_res, preview_id))
+    return device_res, preview_id, {"sha256": sha256, "cached": None, "timings": timings,
+                                    "cost": cost, "roi": roi, "presence": presence, "parity": parity}
+
+
+def report_timings(timings):
+    # called on the request side with the timings an inspect_image worker handed back
+    if not timings:
+        return
+    for stage, seconds in timings.items():
+        if stage == "templates":
+            for tname, elapsed in seconds:
+                METRICS.observe("emsch_template_match_seconds", elapsed, template=tname)
+        else:
+            record_stage(stage, seconds)
+
+
+# ---------- detection pool ----------
+class DetectionPool:
+    def __init__(self, kind=DETECT_POOL, workers=DETECT_WORKERS, queue_size=DETECT_QUEUE_SIZE):
+        self.kind = kind
+        self.workers = workers
+        self.capacity = workers + queue_size
+        self._executor = None
+        self._lock = threading.Lock()
+        self.pending = 0
+        self.accepted = 0
+        self.rejected = 0
+
+    def executor(self):
+        with self._lock:
+            if self._executor is None:
+                if self.kind == "process":
+                    self._executor = ProcessPoolExecutor(max_workers=self.workers)
+                else:
+                    self._executor = ThreadPoolExecutor(max_workers=self.workers,
+                                                        thread_name_prefix="detect")
+            return self._executor
+
+    def reserve(self, n, force=False):
+        # admit a whole upload or nothing, so a request never stalls half-way in the queue.
+        # background jobs are already accepted, they are only counted as load
+        with self._lock:
+            if not force and self.pending and self.pending + n > self.capacity:
+                self.rejected += 1
+                return False
+            self.pending += n
+            self.accepted += 1
+            return True
+
+    def release(self, n):
+        with self._lock:
+            self.pending -= n
+
+    async def run(self, fn, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor(), fn, *args)
+
+    def stats(self):
+        return {
+            "kind": self.kind,
+            "workers": self.workers,
+            "capacity": self.capacity,
+            "pending": self.pending,
+            "accepted": self.accepted,
+            "rejected": self.rejected,
+        }
+
+
+DETECTION_POOL = DetectionPool()
+
+
+def busy_response():
+    return HTMLResponse(
+        "<h3>⏳ 伺服器忙碌中，請稍後 {} 秒再試</h3>".format(BUSY_RETRY_SECONDS),
+        status_code=503,
+        headers={"Retry-After": str(BUSY_RETRY_SECONDS)},
+    )
+
+
+# ---------- page rendering ----------
+class Markup(str):
+    # HTML that is already escaped; inserted into pages as is
+    pass
+
+
+class Page:
+    # an HTML template split once into literal chunks and {field} slots; values are escaped
+    # unless they are Markup, and {field:spec} applies format() first (e.g. {score:.2f})
+    def __init__(self, source):
+        self.parts = [(literal, field, spec) for literal, field, spec, _ in string.Formatter().parse(source)]
+
+    def render(self, **values):
+        out = []
+        for literal, field, spec in self.parts:
+            out.append(literal)
+            if field is not None:
+                value = values[field]
+                if spec:
+                    value = format(value, spec)
+                out.append(value if isinstance(value, Markup) else html.escape(str(value)))
+        return Markup("".join(out))
+
+    def render_all(self, rows):
+        # one join for the whole table instead of += per row
+        return Markup("".join([self.render(**row) for row in rows]))
+
+
+STYLESHEET = """
+body{font-family:Arial; background:#f4f7fb; padding:18px}
+.container{max-width:900px; margin:0 auto}
+.container.narrow{max-width:780px; margin:12px auto}
+.box{max-width:420px; margin:40px auto; background:#fff; padding:18px; border-radius:10px; box-shadow:0 6px 18px rgba(18,24,40,0.06)}
+.box input, .box select{width:100%; padding:10px; margin-top:8px; border-radius:6px; border:1px solid #ddd}
+.box button{background:#1e88ff; color:#fff; border:none; padding:12px; border-radius:8px; width:100%; margin-top:12px}
+.card{background:#fff; padding:16px; border-radius:10px; box-shadow:0 6px 18px rgba(18,24,40,0.06)}
+.card input[type=file]{width:100%}
+.row{display:flex; gap:8px; flex-wrap:wrap}
+.card select, .card input[type=text]{flex:1; padding:10px; border-radius:8px; border:1px solid #ddd}
+button.primary{background:#1e88ff; color:#fff; border:none; padding:12px; border-radius:8px; width:100%}
+button.secondary{background:#fff; color:#1e88ff; border:1px solid #1e88ff; padding:10px; border-radius:8px; width:100%; margin-top:8px}
+a.btn{background:#1e88ff; color:#fff; padding:10px 14px; border-radius:8px; text-decoration:none}
+.filters{display:flex; gap:6px; flex-wrap:wrap; margin-top:10px}
+.filters input{flex:1; min-width:120px; padding:6px; border-radius:6px; border:1px solid #ddd}
+"""
+# the upload form shrinks photos to the advertised working size in the browser, then sends them
+# through /api/uploads in checksummed chunks, retrying each one, so a dropped connection resumes
+# where it stopped (the background button posts to /jobs). without fetch it falls back to the plain post
+UPLOAD_JS = """
+(function () {
+  var form = document.getElementById("upload-form");
+  var status = document.getElementById("upload-status");
+  if (!form || !window.fetch || !window.Promise || !Blob.prototype.arrayBuffer) return;
+  var params = JSON.parse(form.getAttribute("data-params"));
+  var table = [];
+  for (var n = 0; n < 256; n++) {
+    var c = n;
+    for (var k = 0; k < 8; k++) c = c & 1 ? 0xEDB88320 ^ (c >>> 1) : c >>> 1;
+    table[n] = c >>> 0;
+  }
+  function crc32(bytes) {
+    var c = 0xFFFFFFFF;
+    for (var i = 0; i < bytes.length; i++) c = table[(c ^ bytes[i]) & 255] ^ (c >>> 8);
+    return ("0000000" + ((c ^ 0xFFFFFFFF) >>> 0).toString(16)).slice(-8);
+  }
+  function show(text) { status.textContent = text; }
+  function sleep(ms) { return new Promise(function (resolve) { setTimeout(resolve, ms); }); }
+  async function call(method, url, body, headers) {
+    // network errors and 5xx are retried with backoff; 4xx are real errors
+    for (var attempt = 1; ; attempt++) {
+      var response = null;
+      try {
+        response = await fetch(url, {method: method, body: body, headers: headers || {}, credentials: "same-origin"});
+      } catch (e) {}
+      if (response && response.ok) return response.json();
+      if (response && response.status < 500) {
+        var error = await response.json().catch(function () { return {}; });
+        var failed = new Error(error.error || response.status);
+        failed.status = response.status;
+        throw failed;
+      }
+      if (attempt >= 8) throw new Error("網路中斷");
+      show("連線不穩，重試中 (" + attempt + ")…");
+      await sleep(Math.min(1000 * Math.pow(2, attempt - 1), 15000));
+    }
+  }
+  async function shrink(file) {
+    // upright (EXIF applied by the browser), at most params.max_side or else shrunk by params.scale,
+    // re-encoded as JPEG; returns the file and the scale the server has to match it at (1 when the
+    // original is kept: already small enough, or the browser cannot decode it)
+    var kept = {file: file, scale: 1};
+    if (!window.createImageBitmap) return kept;
+    var bitmap;
+    try {
+      bitmap = await createImageBitmap(file, {imageOrientation: "from-image"});
+    } catch (e) {
+      return kept;
+    }
+    var scale = params.max_side ? Math.min(1, params.max_side / Math.max(bitmap.width, bitmap.height)) : params.scale;
+    if (scale === 1 && file.type === "image/jpeg") return kept;
+    var source = bitmap, width = bitmap.width, height = bitmap.height;
+    var targetW = Math.round(width * scale), targetH = Math.round(height * scale);
+    var canvas;
+    do {
+      // halve step by step: one big drawImage step aliases fine detail the matcher needs
+      width = Math.max(targetW, Math.round(width / 2));
+      height = Math.max(targetH, Math.round(height / 2));
+      if (scale === 1) { width = targetW; height = targetH; }
+      canvas = document.createElement("canvas");
+      canvas.width = width;
+      canvas.height = height;
+      var ctx = canvas.getContext("2d");
+      ctx.imageSmoothingQuality = "high";
+      ctx.drawImage(source, 0, 0, width, height);
+      source = canvas;
+    } while (width > targetW || height > targetH);
+    var blob = await new Promise(function (resolve) { canvas.toBlob(resolve, params.format, params.quality / 100); });
+    if (!blob || blob.size >= file.size) return kept;
+    var name = file.name.replace(/\\.[^.]*$/, "") + ".jpg";
+    // with max_side the server resizes every photo to it anyway, so only a plain shrink is reported
+    return {file: new File([blob], name, {type: params.format}), scale: params.max_side ? 1 : scale};
+  }
+  async function prepare(files, original) {
+    var out = [];
+    for (var i = 0; i < files.length; i++) {
+      show("壓縮照片 " + (i + 1) + " / " + files.length + "…");
+      out.push(original ? {file: files[i], scale: 1} : await shrink(files[i]));
+    }
+    return out;
+  }
+  var current = null;
+  form.addEventListener("submit", async function (event) {
+    var via = event.submitter || document.activeElement;
+    var background = via && via.hasAttribute("formaction");
+    event.preventDefault();
+    var box = form.elements.keep_original;
+    var original = !!(box && box.checked);
+    var picked = Array.prototype.slice.call(form.elements.files.files);
+    var vehicle = {vehicle_type: form.elements.vehicle_type.value, vehicle_id: form.elements.vehicle_id.value};
+    var key = JSON.stringify([vehicle, original, picked.map(function (f) { return [f.name, f.size, f.lastModified]; })]);
+    try {
+      if (!current || current.key !== key) {
+        // compressed once: a resumed upload has to send exactly the same bytes
+        current = {key: key, files: await prepare(picked, original)};
+      }
+      var files = current.files.map(function (p) { return p.file; });
+      var scales = current.files.map(function (p) { return p.scale; });
+      if (background) {
+        var data = new FormData();
+        data.append("vehicle_type", vehicle.vehicle_type);
+        data.append("vehicle_id", vehicle.vehicle_id);
+        files.forEach(function (f, i) { data.append("files", f, f.name); data.append("scales", scales[i]); });
+        show("上傳中…");
+        var job = await call("POST", "/jobs", data, {"Accept": "application/json"});
+        current = null;
+        location.href = job.page_url;
+        return;
+      }
+      if (!current.id) {
+        var created = await call("POST", "/api/uploads", JSON.stringify({
+          vehicle_type: vehicle.vehicle_type, vehicle_id: vehicle.vehicle_id,
+          files: files.map(function (f, i) { return {name: f.name, size: f.size, scale: scales[i]}; })
+        }), {"Content-Type": "application/json"});
+        current.id = created.upload_id;
+        current.chunk = created.chunk_size;
+      }
+      var state = await call("GET", "/api/uploads/" + current.id);
+      for (var i = 0; i < files.length; i++) {
+        var info = state.files[i];
+        var count = Math.max(1, Math.ceil(files[i].size / current.chunk));
+        for (var n = 0; n < count && !info.complete; n++) {
+          if (info.received.indexOf(n) >= 0) continue;
+          var bytes = new Uint8Array(await files[i].slice(n * current.chunk, (n + 1) * current.chunk).arrayBuffer());
+          show("上傳中 " + (i + 1) + " / " + files.length + "：" + Math.round(100 * (n + 1) / count) + "%");
+          await call("PUT", "/api/uploads/" + current.id + "/" + i + "/" + n, bytes, {"X-Chunk-CRC32": crc32(bytes)});
+        }
+      }
+      show("檢測中…");
+      var done = await call("POST", "/api/uploads/" + current.id + "/finish");
+      current = null;
+      location.href = done.page_url;
+    } catch (e) {
+      if (e.status === 404) {
+        // the server no longer has this upload (expired or finished elsewhere): start over next time
+        current = null;
+        show("❌ " + e.message + "；請再按一次重新上傳");
+        return;
+      }
+      show("❌ " + e.message + "；再按一次會從中斷處繼續");
+    }
+  });
+})();
+"""
+
+
+def static_name(prefix, content, ext):
+    return "{}.{}.{}".format(prefix, hashlib.sha1(content.encode("utf-8")).hexdigest()[:10], ext)
+
+
+STATIC_FILES = {
+    static_name("app", STYLESHEET, "css"): (STYLESHEET, "text/css"),
+    static_name("upload", UPLOAD_JS, "js"): (UPLOAD_JS, "application/javascript"),
+}
+STYLESHEET_URL = "/static/" + static_name("app", STYLESHEET, "css")
+UPLOAD_JS_URL = "/static/" + static_name("upload", UPLOAD_JS, "js")
+
+PAGE_HEAD = Page("""
+    <html>
+      <head>{head_extra}
+        <meta name="viewport" content="width=device-width, initial-scale=1">
+        <title>{title}</title>
+        <link rel="stylesheet" href="{stylesheet}">
+      </head>
+      <body>
+""")
+
+
+def page_head(title, head_extra=Markup("")):
+    return PAGE_HEAD.render(title=title, head_extra=head_extra, stylesheet=STYLESHEET_URL)
+
+
+PAGE_TAIL = """
+      </body>
+    </html>
+"""
+
+LOGIN_PAGE = Page("""
+        <div class="box">
+          <h2 style="text-align:center">🔐 登入 - 救護車設備 AI</h2>
+          <form action="/login" method="post">
+            <label>分隊</label>
+            <select name="division" required>{options}</select>
+            <label style="margin-top:8px">隊員姓名</label>
+            <input name="username" placeholder="輸入隊員姓名" required>
+            <button type="submit">登入</button>
+          </form>
+        </div>
+""")
+OPTION = Page("<option value='{value}'>{value}</option>")
+
+# the login page never changes, so it is rendered once
+LOGIN_HTML = (page_head("登入 - 救護車設備 AI")
+              + LOGIN_PAGE.render(options=OPTION.render_all({"value": d} for d in DIVISIONS))
+              + PAGE_TAIL)
+
+UPLOAD_PAGE = Page("""
+        <div class="container narrow">
+          <div style="display:flex; justify-content:space-between; align-items:center; margin-bottom:8px;">
+            <div><strong>分隊：</strong>{division} &nbsp;&nbsp; <strong>隊員：</strong>{user}</div>
+            <div><a href="/logout">登出</a></div>
+          </div>
+
+          <div class="card">
+            <h3>📸 上傳檢查照片 (最多 {max_upload} 張)</h3>
+            <form id="upload-form" action="/upload" enctype="multipart/form-data" method="post" data-params='{params}'>
+              <div style="margin-bottom:8px;" class="row">
+                <select name="vehicle_type" required>
+                  <option value="救護車">救護車</option>
+                  <option value="消防車">消防車</option>
+                </select>
+                <input type="text" name="vehicle_id" placeholder="車輛編號 (例如 A1-1)" required>
+              </div>
+              <input type="file" name="files" accept="image/*" multiple required>
+              {keep_original}
+              <br>
+              <button class="primary" type="submit">上傳並檢查</button>
+              <button class="secondary" type="submit" formaction="/jobs">背景檢查 (網路不穩時使用)</button>
+            </form>
+            <p id="upload-status" style="color:#555"></p>
+            <small style="color:#666">Templates: {template_dir}</small>
+          </div>
+
+          <div style="text-align:center; margin-top:12px;">
+            <a href="/records">查看最近紀錄</a>
+          </div>
+        </div>
+        <script src="{upload_js}"></script>
+""")
+
+
+@app.get("/static/{name}")
+async def static_file(name: str):
+    # public (the login page needs it) and immutable: the file name changes with the content
+    if name not in STATIC_FILES:
+        return Response(status_code=404)
+    content, media_type = STATIC_FILES[name]
+    return Response(content, media_type=media_type,
+                    headers={"Cache-Control": "public, max-age={}, immutable".format(STATIC_MAX_AGE)})
+
+
+# ---------- routes ----------
+@app.get("/", response_class=HTMLResponse)
+async def root(request: Request):
+    if request.session.get("user"):
+        return RedirectResponse(url="/upload_form")
+    return HTMLResponse(LOGIN_HTML)
+
+
+@app.post("/login")
+async def login(request: Request, division: str = Form(...), username: str = Form(...)):
+    request.session["user"] = username
+    request.session["division"] = division
+    return RedirectResponse(url="/upload_form", status_code=303)
+
+
+@app.get("/logout")
+async def logout(request: Request):
+    request.session.clear()
+    return RedirectResponse(url="/")
+
+
+def client_upload_params():
+    # what the browser needs to shrink photos without hurting detection. with WORK_MAX_SIDE photos are
+    # resized to it anyway, so the form sends them at that size (max_side); at full size every photo is
+    # shrunk by `scale` and the form reports the factor it used, so the templates can follow
+    template_set = TEMPLATE_STORE.get()
+    return {
+        "max_side": CLIENT_MAX_SIDE or WORK_MAX_SIDE,
+        "scale": client_scale(template_set),
+        "quality": CLIENT_JPEG_QUALITY,
+        "format": "image/jpeg",
+        "max_files": MAX_UPLOAD,
+        "chunk_size": UPLOADS.chunk_size,
+        "keep_originals": bool(AUDIT_DIR),
+        "template_version": template_set.version,
+    }
+
+
+@app.get("/api/upload-params")
+async def upload_params(request: Request):
+    if not request.session.get("user"):
+        return RedirectResponse(url="/")
+    return client_upload_params()
+
+
+# only offered when AUDIT_DIR keeps the originals; unticked, so photos are shrunk unless asked otherwise
+KEEP_ORIGINAL = Markup("<label style=\"display:block; margin-top:8px; color:#555\">"
+                       "<input type=\"checkbox\" name=\"keep_original\"> 上傳原始照片 (稽核用，檔案較大)</label>")
+
+
+@app.get("/upload_form", response_class=HTMLResponse)
+async def upload_form(request: Request):
+    if not request.session.get("user"):
+        return RedirectResponse(url="/")
+
+    page = (page_head("上傳 - 救護車設備 AI")
+            + UPLOAD_PAGE.render(division=request.session["division"], user=request.session["user"],
+                                 max_upload=MAX_UPLOAD, template_dir=TEMPLATE_DIR, upload_js=UPLOAD_JS_URL,
+                                 params=json.dumps(client_upload_params()),
+                                 keep_original=KEEP_ORIGINAL if AUDIT_DIR else "")
+            + PAGE_TAIL)
+    return HTMLResponse(page)
+
+
+CACHED_NOTES = {
+    "exact": "<p style='color:#8a6d00'>♻ 與近期上傳的照片相同，沿用先前結果</p>",
+}
+
+
+def variant_note(cost):
+    if not cost:
+        return ""
+    return "<p style='color:#888; font-size:12px'>多尺度/旋轉比對：{} 種變化，粗比對 {}，精比對 {} (全搜尋 {})</p>".format(
+        cost["variants"], cost.get("probed", 0), cost.get("refined", 0), cost["exhaustive"])
+
+
+CARD = Page("""
+        <div style="background:#fff; padding:14px; border-radius:10px; margin-bottom:18px;">
+          <h3>📸 圖片 {idx} : {filename}</h3>{notes}
+          <div style="text-align:center;">{preview}</div>
+          <table style="width:100%; margin-top:10px; border-collapse:collapse;">
+            <thead><tr style="background:#eef3ff"><th>設備</th><th>結果</th><th>相似度</th><th>模板</th></tr></thead>
+            <tbody>{rows}</tbody>
+          </table>
+        </div>
+        """)
+CARD_ROW = Page("<tr><td>{device}</td><td>{status}</td><td>{score:.2f}</td><td>{template}</td></tr>")
+CARD_PREVIEW = Page("<a href='/preview/{pid}'><img src='/preview/{pid}?size=medium' loading='lazy' "
+                    "style='max-width:94%; border-radius:8px;'></a>")
+CARD_EMPTY = Markup("<tr><td colspan='4' style='padding:8px'>無高相似度結果</td></tr>")
+
+
+def render_card(idx, filename, preview_id, device_res, cached=None, cost=None):
+    preview = CARD_PREVIEW.render(pid=preview_id) if preview_id is not None else Markup("")
+    rows = CARD_ROW.render_all(
+        {"device": device, "status": "✔" if info["detected"] else "✘", "score": info["score"],
+         "template": info["template"]}
+        for device, info in device_res.items() if info["score"] >= THRESHOLD
+    )
+    return CARD.render(idx=idx, filename=filename, notes=Markup(CACHED_NOTES.get(cached, "") + variant_note(cost)),
+                       preview=preview, rows=rows or CARD_EMPTY)
+
+
+async def run_inspection(filenames, uploads, emit, devices=None, progress=None, started=None, rois=None,
+                         vehicle_id=None, scales=None):
+    # all images are submitted at once; cards are emitted in upload order as soon as they are ready.
+    # presence mode goes photo by photo instead, so devices confirmed earlier are skipped later.
+    # `started` maps photo index -> detection already running (resumable uploads start each photo on arrival)
+    started = started or {}
+    scales = scales or [1.0] * len(uploads)
+    PREVIEW_SWEEPER.maybe_sweep()
+    if PRESENCE_MODE:
+        jobs = [started.get(i) for i in range(len(uploads))]
+    else:
+        jobs = [started.get(i)
+                or asyncio.ensure_future(DETECTION_POOL.run(inspect_image, data, (), devices, rois, vehicle_id,
+                                                            scales[i]))
+                for i, data in enumerate(uploads)]
+
+    all_results = {}
+    photos = {}
+    confirmed = set()
+    for idx, (filename, data, job, scale) in enumerate(zip(filenames, uploads, jobs, scales), start=1):
+        if job is None:
+            result = await DETECTION_POOL.run(inspect_image, data, frozenset(confirmed), devices, rois, vehicle_id,
+                                              scale)
+        else:
+            result = await job
+        if progress is not None:
+            await progress(idx)
+        if result is None:
+            continue
+        device_res, preview_id, photo = result
+        report_timings(photo["timings"])
+        if photo.get("cost"):
+            VARIANT_STATS.record(photo["cost"])
+        if photo.get("roi"):
+            ROI_STATS.record(photo["roi"])
+        for entry in photo.get("presence", ()):
+            PRESENCE_STATS.record(*entry)
+        for exact, fast in photo.get("parity", {}).get("pyramid", ()):
+            PYRAMID_PARITY.record(exact, fast)
+        for exact, fast in photo.get("parity", {}).get("fft", ()):
+            FFT_PARITY.record(exact, fast)
+        confirmed.update(device for device, info in device_res.items() if info["detected"])
+
+        all_results[filename] = device_res
+        photos[filename] = dict(photo, preview=preview_id)
+        await emit(render_card(idx, filename, preview_id, device_res, photo["cached"], photo.get("cost")))
+
+    return all_results, photos
+
+
+MISSING_CARD = Page("""
+        <div style="background:#fff; padding:14px; border-radius:10px; margin-bottom:18px;">
+          <h3>🧰 應備設備檢查</h3>
+          {items}
+        </div>
+        """)
+MISSING_NONE = Page("<p style='color:#2e7d32'>✔ 應備設備 {expected} 項皆已偵測到</p>")
+MISSING_LIST = Page("<p style='color:#c62828'>✘ 缺少 {missing} / {expected} 項設備</p><ul>{items}</ul>")
+MISSING_ITEM = Page("<li>{device}{note}</li>")
+
+
+def render_missing(expected, missing, template_devices):
+    if not missing:
+        items = MISSING_NONE.render(expected=len(expected))
+    else:
+        items = MISSING_LIST.render(missing=len(missing), expected=len(expected), items=MISSING_ITEM.render_all(
+            {"device": device, "note": "" if device in template_devices else "（無模板，無法比對）"} for device in missing
+        ))
+    return MISSING_CARD.render(items=items)
+
+
+async def inspect_and_record(meta, filenames, uploads, emit, progress=None, job_id=None, started=None,
+                             job_owner=None):
+    # shared by direct uploads, background jobs and resumable uploads; returns the save_record future.
+    # meta["scales"]: per photo, how far the upload form shrank it
+    expected = MANIFESTS.devices_for(meta["vehicle_type"], meta["vehicle_id"])
+    rois = await asyncio.to_thread(last_positions, meta["vehicle_id"]) if ROI_SEARCH else None
+    all_results, photos = await run_inspection(filenames, uploads, emit, expected, progress, started, rois,
+                                               meta["vehicle_id"], meta.get("scales"))
+    missing = None
+    if expected is not None:
+        missing = missing_devices(expected, all_results)
+        await emit(render_missing(expected, missing, TEMPLATE_STORE.get().devices))
+    saved = save_record(meta["division"], meta["username"], meta["vehicle_type"], meta["vehicle_id"],
+                        all_results, missing, job_id, photos, job_owner)
+    if AUDIT_DIR:
+        audit_meta = dict({"timestamp": datetime.utcnow().isoformat()}, **meta)
+        await asyncio.to_thread(store_audit, audit_meta, filenames, uploads)
+    return saved
+
+
+def store_audit(meta, filenames, uploads):
+    # originals are stored once per content hash; each request only writes a manifest
+    images = []
+    for filename, data in zip(filenames, uploads):
+        digest = hashlib.sha256(data).hexdigest()
+        ext = os.path.splitext(filename or "")[1].lower() or ".jpg"
+        obj = "objects/{}/{}{}".format(digest[:2], digest, ext)
+        path = os.path.join(AUDIT_DIR, obj)
+        if not os.path.exists(path):
+            write_atomic(path, data)
+        images.append({"filename": filename, "sha256": digest, "size": len(data),
+                       "object": obj})
+
+    request_id = uuid.uuid4().hex
+    folder = os.path.join(AUDIT_DIR, "requests", meta["timestamp"][:10])
+    os.makedirs(folder, exist_ok=True)
+    with open(os.path.join(folder, request_id + ".json"), "w", encoding="utf-8") as f:
+        json.dump(dict(meta, request_id=request_id, images=images), f, ensure_ascii=False, indent=2)
+    return request_id
+
+
+RESULT_PAGE_TOP = """
+        <div class="container">
+          <div style="display:flex; justify-content:space-between; align-items:center;">
+            <h2>🔎 檢測結果總覽</h2>
+            <a href="/upload_form" class="btn">返回</a>
+          </div>
+"""
+RESULT_PAGE_HEAD = page_head("檢測結果") + RESULT_PAGE_TOP
+RESULT_PAGE_TAIL = """
+        </div>""" + PAGE_TAIL
+
+# background inspections keep running even if the phone drops the connection
+BACKGROUND_TASKS = set()
+
+
+def spawn(coro):
+    task = asyncio.ensure_future(coro)
+    BACKGROUND_TASKS.add(task)
+    task.add_done_callback(BACKGROUND_TASKS.discard)
+    return task
+
+
+async def stream_page(cards):
+    yield RESULT_PAGE_HEAD
+    while True:
+        card = await cards.get()
+        if card is None:
+            break
+        yield card
+    yield RESULT_PAGE_TAIL
+
+
+@app.post("/upload", response_class=HTMLResponse)
+async def upload(request: Request, files: List[UploadFile] = File(...),
+                 vehicle_type: str = Form(...), vehicle_id: str = Form(...), scales: List[str] = Form([])):
+
+    if not request.session.get("user"):
+        return RedirectResponse(url="/")
+
+    user = request.session["user"]
+    division = request.session["division"]
+
+    if len(files) == 0:
+        return HTMLResponse("<h3>❌ 請上傳至少一張圖片</h3>")
+    if len(files) > MAX_UPLOAD:
+        return HTMLResponse("<h3>❌ 最多上傳 {} 張圖片</h3>".format(MAX_UPLOAD))
+
+    with stage_timer("templates"):
+        template_set = TEMPLATE_STORE.get()
+    if not template_set.templates:
+        return HTMLResponse("<h3>❌ templates 資料夾中沒有模板圖片！</h3>")
+
+    if not DETECTION_POOL.reserve(len(files)):
+        return busy_response()
+
+    filenames = [file.filename for file in files]
+    try:
+        with stage_timer("read"):
+            uploads = [await file.read() for file in files]
+    except Exception:
+        DETECTION_POOL.release(len(files))
+        raise
+    meta = {"division": division, "username": user, "vehicle_type": vehicle_type, "vehicle_id": vehicle_id,
+            "scales": photo_scales(scales, len(files))}
+    cards = asyncio.Queue()
+
+    async def inspect_and_save():
+        try:
+            try:
+                saved = await inspect_and_record(meta, filenames, uploads, cards.put)
+            finally:
+                DETECTION_POOL.release(len(files))
+            # the results are already on the page; tell the crew when they were not kept
+            try:
+                await asyncio.wrap_future(saved)
+            except Exception:
+                await cards.put("<h3>❌ 檢測結果未能儲存，請重新上傳</h3>")
+        except Exception:
+            log.exception("inspection failed")
+            await cards.put("<h3>❌ 檢測失敗，請重新上傳</h3>")
+        finally:
+            await cards.put(None)
+
+    spawn(inspect_and_save())
+    return StreamingResponse(stream_page(cards), media_type="text/html; charset=utf-8")
+
+
+# ---------- background inspection jobs ----------
+JOB_COLUMNS = ["id", "created", "updated", "status", "division", "username", "vehicle_type", "vehicle_id",
+               "filenames", "total", "done", "cards", "record_id", "error"]
+
+
+@write_op
+def insert_job(c, row):
+    c.execute(
+        "INSERT INTO jobs (id, created, updated, status, division, username, vehicle_type, vehicle_id, "
+        "filenames, total, done, cards) VALUES (?, ?, ?, 'queued', ?, ?, ?, ?, ?, ?, 0, '[]')", row
+    )
+
+
+@write_op
+def update_job(c, job_id, fields, owner):
+    # only while the run that claimed the job still has it running; returns whether it did
+    names = [name for name in fields if name in JOB_COLUMNS and name != "id"]
+    c.execute("UPDATE jobs SET {} WHERE id = ? AND owner = ? AND status = 'running'".format(
+        ", ".join(name + " = ?" for name in names)), [fields[name] for name in names] + [job_id, owner])
+    return c.rowcount == 1
+
+
+@read_op
+def waiting_jobs(c, stale_before):
+    return c.execute(
+        "SELECT id FROM jobs WHERE status = 'queued' OR (status = 'running' AND updated < ?) ORDER BY created",
+        (stale_before,)
+    ).fetchall()
+
+
+@read_op
+def get_job(c, job_id):
+    return c.execute("SELECT {} FROM jobs WHERE id = ?".format(", ".join(JOB_COLUMNS)), (job_id,)).fetchone()
+
+
+@write_op
+def claim_job(c, job_id, now, stale_before, owner):
+    # only one worker (in any process) gets a queued job, or a running one whose owner stopped reporting
+    c.execute(
+        "UPDATE jobs SET status = 'running', done = 0, cards = '[]', updated = ?, owner = ? "
+        "WHERE id = ? AND (status = 'queued' OR (status = 'running' AND updated < ?))",
+        (now, owner, job_id, stale_before)
+    )
+    return c.rowcount == 1
+
+
+class JobQueue:
+    # uploads are written to disk and the jobs table before they are acknowledged,
+    # then inspected by worker threads. every worker process polls for queued jobs and
+    # running ones that went quiet (a restart, a killed worker); claim_job decides who runs them
+    def __init__(self, folder=JOB_DIR, workers=JOB_WORKERS, max_queued=JOB_QUEUE_MAX):
+        self.folder = folder
+        self.workers = workers
+        self.max_queued = max_queued
+        self._queue = queue.Queue()
+        self._pending = set()
+        self._threads = []
+        self._lock = threading.Lock()
+        self.submitted = 0
+        self.claimed = 0
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+
+    def photo_path(self, job_id, idx):
+        return os.path.join(self.folder, job_id, "{}.img".format(idx))
+
+    def submit(self, meta, filenames, uploads):
+        # blocking; returns the job id, or None when the backlog is full
+        if self._queue.qsize() >= self.max_queued:
+            self.rejected += 1
+            return None
+        job_id = uuid.uuid4().hex
+        for idx, data in enumerate(uploads):
+            write_atomic(self.photo_path(job_id, idx), data)
+        # scales stay with the photos, on the node that runs the job
+        write_atomic(os.path.join(self.folder, job_id, "scales.json"), json.dumps(meta["scales"]).encode("utf-8"))
+        now = datetime.utcnow().isoformat()
+        row = (job_id, now, now, meta["division"], meta["username"], meta["vehicle_type"], meta["vehicle_id"],
+               json.dumps(filenames, ensure_ascii=False), len(filenames))
+        RECORD_WRITER.write("insert_job", row).result()
+        self.submitted += 1
+        self._enqueue(job_id)
+        return job_id
+
+    def stale_before(self):
+        return datetime.utcfromtimestamp(time.time() - JOB_STALE_SECONDS).isoformat()
+
+    def recover(self):
+        # queued jobs and stalled running ones whose photos are on this node go on the local queue
+        self._start_workers()
+        rows = read("waiting_jobs", self.stale_before())
+        found = 0
+        for (job_id,) in rows:
+            if os.path.isdir(os.path.join(self.folder, job_id)):
+                self._enqueue(job_id)
+                found += 1
+        return found
+
+    def get(self, job_id):
+        row = read("get_job", job_id)
+        if row is None:
+            return None
+        job = dict(zip(JOB_COLUMNS, row))
+        job["filenames"] = json.loads(job["filenames"])
+        job["cards"] = json.loads(job["cards"] or "[]")
+        return job
+
+    def _start_workers(self):
+        with self._lock:
+            self._threads = [t for t in self._threads if t.is_alive()]
+            while len(self._threads) < self.workers:
+                thread = threading.Thread(target=self._run, name="inspection-job", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def _enqueue(self, job_id):
+        self._start_workers()
+        with self._lock:
+            if job_id in self._pending:
+                return
+            self._pending.add(job_id)
+        self._queue.put(job_id)
+
+    def _update(self, job_id, owner, **fields):
+        fields["updated"] = datetime.utcnow().isoformat()
+        return RECORD_WRITER.write("update_job", job_id, fields, owner)
+
+    def _run(self):
+        while True:
+            try:
+                job_id = self._queue.get(timeout=JOB_RECOVER_SECONDS)
+            except queue.Empty:
+                try:
+                    self.recover()
+                except Exception:
+                    log.exception("job recovery failed")
+                continue
+            # a token per attempt: a run that lost the job to another worker can no longer touch it
+            owner = uuid.uuid4().hex
+            try:
+                if asyncio.run(self._process(job_id, owner)):
+                    self.completed += 1
+            except Exception as e:
+                log.exception("inspection job %s failed", job_id)
+                self.failed += 1
+                self._update(job_id, owner, status="failed", error=str(e))
+            finally:
+                with self._lock:
+                    self._pending.discard(job_id)
+
+    async def _process(self, job_id, owner):
+        # returns False when another worker has the job
+        now = datetime.utcnow().isoformat()
+        if not await asyncio.wrap_future(RECORD_WRITER.write("claim_job", job_id, now, self.stale_before(), owner)):
+            return False
+        self.claimed += 1
+        job = self.get(job_id)
+        uploads = []
+        for idx in range(job["total"]):
+            with open(self.photo_path(job_id, idx), "rb") as f:
+                uploads.append(f.read())
+
+        cards = []
+
+        async def emit(card):
+            cards.append(card)
+            self._update(job_id, owner, cards=json.dumps(cards, ensure_ascii=False))
+
+        async def progress(done):
+            self._update(job_id, owner, done=done)
+
+        async def heartbeat():
+            # photos can wait in the detection pool for a while; the job must not look stalled meanwhile
+            while True:
+                await asyncio.sleep(JOB_STALE_SECONDS / 4)
+                self._update(job_id, owner)
+
+        meta = {name: job[name] for name in ("division", "username", "vehicle_type", "vehicle_id")}
+        try:
+            with open(os.path.join(self.folder, job_id, "scales.json"), encoding="utf-8") as f:
+                meta["scales"] = photo_scales(json.load(f), job["total"])
+        except (OSError, ValueError):
+            pass
+        DETECTION_POOL.reserve(job["total"], force=True)
+        alive = asyncio.ensure_future(heartbeat())
+        try:
+            saved = await inspect_and_record(meta, job["filenames"], uploads, emit, progress, job_id,
+                                             job_owner=owner)
+            await asyncio.wrap_future(saved)
+        finally:
+            alive.cancel()
+            DETECTION_POOL.release(job["total"])
+        shutil.rmtree(os.path.join(self.folder, job_id), ignore_errors=True)
+        return True
+
+    def stats(self):
+        return {
+            "workers": self.workers,
+            "queued": self._queue.qsize(),
+            "submitted": self.submitted,
+            "claimed": self.claimed,
+            "completed": self.completed,
+            "failed": self.failed,
+            "rejected": self.rejected,
+        }
+
+
+JOBS = JobQueue()
+
+
+def resume_jobs():
+    # resume background inspections left unfinished by the last run; called from lifespan, so only in
+    # serving workers. if the records are unreachable now, the idle job workers try again every
+    # JOB_RECOVER_SECONDS
+    try:
+        JOBS.recover()
+    except Exception:
+        log.exception("job recovery failed")
+
+
+def job_status(job):
+    return {name: job[name] for name in ("id", "status", "total", "done", "record_id", "error", "created", "updated")}
+
+
+@app.post("/jobs")
+async def submit_job(request: Request, files: List[UploadFile] = File(...),
+                     vehicle_type: str = Form(...), vehicle_id: str = Form(...), scales: List[str] = Form([])):
+    # same form as /upload, but answers as soon as the photos are stored
+    if not request.session.get("user"):
+        return RedirectResponse(url="/")
+
+    if len(files) == 0:
+        return HTMLResponse("<h3>❌ 請上傳至少一張圖片</h3>")
+    if len(files) > MAX_UPLOAD:
+        return HTMLResponse("<h3>❌ 最多上傳 {} 張圖片</h3>".format(MAX_UPLOAD))
+    if not TEMPLATE_STORE.get().templates:
+        return HTMLResponse("<h3>❌ templates 資料夾中沒有模板圖片！</h3>")
+
+    meta = {"division": request.session["division"], "username": request.session["user"],
+            "vehicle_type": vehicle_type, "vehicle_id": vehicle_id, "scales": photo_scales(scales, len(files))}
+    filenames = [file.filename for file in files]
+    uploads = [await file.read() for file in files]
+    job_id = await asyncio.to_thread(JOBS.submit, meta, filenames, uploads)
+    if job_id is None:
+        return busy_response()
+
+    if "application/json" in request.headers.get("accept", ""):
+        return JSONResponse({"job_id": job_id, "status_url": "/api/jobs/" + job_id, "page_url": "/jobs/" + job_id},
+                            status_code=202)
+    return RedirectResponse(url="/jobs/" + job_id, status_code=303)
+
+
+@app.get("/api/jobs/{job_id}")
+async def job_api(request: Request, job_id: str):
+    if not request.session.get("user"):
+        return RedirectResponse(url="/")
+    job = await asyncio.to_thread(JOBS.get, job_id)
+    if job is None:
+        return JSONResponse({"error": "job not found"}, status_code=404)
+    return job_status(job)
+
+
+JOB_REFRESH = Page("\n        <meta http-equiv='refresh' content='{seconds}'>")
+
+
+@app.get("/jobs/{job_id}", response_class=HTMLResponse)
+async def job_page(request: Request, job_id: str):
+    if not request.session.get("user"):
+        return RedirectResponse(url="/")
+    job = await asyncio.to_thread(JOBS.get, job_id)
+    if job is None:
+        return HTMLResponse("<h3>❌ 找不到此檢測工作</h3>", status_code=404)
+
+    head = RESULT_PAGE_HEAD
+    if job["status"] == "queued":
+        state = "⏳ 排隊中，共 {} 張照片".format(job["total"])
+    elif job["status"] == "running":
+        state = "🔎 檢測中 {} / {}".format(job["done"], job["total"])
+    elif job["status"] == "done":
+        state = "✔ 檢測完成，<a href='/records/{0}'>紀錄 #{0}</a>".format(int(job["record_id"]))
+    else:
+        state = "❌ 檢測失敗，請重新上傳"
+    if job["status"] in ("queued", "running"):
+        head = page_head("檢測結果", JOB_REFRESH.render(seconds=JOB_REFRESH_SECONDS)) + RESULT_PAGE_TOP
+
+    page = head + "<p>" + state + "</p>" + "".join(job["cards"]) + RESULT_PAGE_TAIL
+    return HTMLResponse(page)
+
+
+# ---------- resumable uploads ----------
+UPLOAD_ID = re.compile(r"[0-9a-f]{32}")
+
+
+class UploadSessions:
+    # photos arrive in checksummed chunks stored as separate files, so any worker can take any chunk
+    # and a dropped connection only costs the chunk in flight. a photo is assembled, and its detection
+    # started, as soon as its last chunk lands; finish() waits for those and saves the record.
+    # assembling a photo and finishing are claimed with lock files, so only one worker does each
+    def __init__(self, folder=UPLOAD_DIR, chunk_size=UPLOAD_CHUNK_SIZE):
+        self.folder = folder
+        self.chunk_size = chunk_size
+        self._detections = {}    # (upload_id, index) -> detection task started on arrival
+        self._finishing = {}     # upload_id -> task saving the record
+        self.created = 0
+        self.chunks = 0
+        self.rejected_chunks = 0
+        self.assembled = 0
+        self.started_early = 0
+        self.finished = 0
+
+    def path(self, upload_id, *parts):
+        return os.path.join(self.folder, upload_id, *parts)
+
+    def create(self, meta, files):
+        self.sweep()
+        upload_id = uuid.uuid4().hex
+        session = {"meta": meta, "files": files, "chunk_size": self.chunk_size,
+                   "created": datetime.utcnow().isoformat()}
+        write_atomic(self.path(upload_id, "session.json"), json.dumps(session, ensure_ascii=False).encode("utf-8"))
+        self.created += 1
+        return upload_id
+
+    def load(self, upload_id):
+        if not UPLOAD_ID.fullmatch(upload_id):
+            return None
+        try:
+            with open(self.path(upload_id, "session.json"), encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def chunk_count(self, session, index):
+        return max(1, -(-session["files"][index]["size"] // session["chunk_size"]))
+
+    def photo_path(self, upload_id, index):
+        return self.path(upload_id, "{}.img".format(index))
+
+    def result_path(self, upload_id, index):
+        return self.path(upload_id, "{}.result".format(index))
+
+    def claim(self, upload_id, name):
+        # the worker that creates <name>.lock owns the step; a lock nobody touched for UPLOAD_LOCK_STALE
+        # seconds belongs to a worker that died and is taken over
+        lock = self.path(upload_id, name + ".lock")
+        try:
+            os.close(os.open(lock, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+            return True
+        except FileExistsError:
+            pass
+        except OSError:
+            return False
+        try:
+            if time.time() - os.stat(lock).st_mtime < UPLOAD_LOCK_STALE:
+                return False
+            # renamed first, so two workers taking over the same lock cannot both succeed
+            grabbed = "{}.{}.stale".format(lock, uuid.uuid4().hex)
+            os.rename(lock, grabbed)
+        except OSError:
+            return False
+        fresh = time.time() - os.stat(grabbed).st_mtime < UPLOAD_LOCK_STALE
+        if fresh:
+            # someone else took it over in between: give the lock back
+            try:
+                os.link(grabbed, lock)
+            except OSError:
+                pass
+        os.remove(grabbed)
+        return not fresh and self.claim(upload_id, name)
+
+    def release(self, upload_id, name):
+        try:
+            os.remove(self.path(upload_id, name + ".lock"))
+        except OSError:
+            pass
+
+    async def keep_claim(self, upload_id, name):
+        while True:
+            await asyncio.sleep(UPLOAD_LOCK_STALE / 4)
+            try:
+                os.utime(self.path(upload_id, name + ".lock"))
+            except OSError:
+                pass
+
+    def received(self, upload_id, index):
+        try:
+            return sorted(int(name.split(".")[0]) for name in os.listdir(self.path(upload_id, str(index)))
+                          if name.endswith(".chunk"))
+        except OSError:
+            return []
+
+    def status(self, upload_id, session):
+        files = []
+        for index, spec in enumerate(session["files"]):
+            complete = os.path.exists(self.photo_path(upload_id, index))
+            files.append({"name": spec["name"], "size": spec["size"], "complete": complete,
+                          "chunks": self.chunk_count(session, index),
+                          "received": list(range(self.chunk_count(session, index))) if complete
+                          else self.received(upload_id, index)})
+        return {"upload_id": upload_id, "chunk_size": session["chunk_size"], "files": files,
+                "record_id": self.record_id(upload_id)}
+
+    def put_chunk(self, upload_id, session, index, n, data):
+        # returns the assembled photo once its last chunk is in, otherwise None
+        write_atomic(self.path(upload_id, str(index), "{:05d}.chunk".format(n)), data)
+        self.chunks += 1
+        count = self.chunk_count(session, index)
+        if len(self.received(upload_id, index)) < count:
+            return None
+        # two last chunks can land at once, on any worker: one of them assembles the photo
+        lock = "{}.assemble".format(index)
+        if not self.claim(upload_id, lock):
+            return None
+        try:
+            if os.path.exists(self.photo_path(upload_id, index)):
+                return None
+            parts = []
+            for i in range(count):
+                with open(self.path(upload_id, str(index), "{:05d}.chunk".format(i)), "rb") as f:
+                    parts.append(f.read())
+            photo = b"".join(parts)
+            expected = session["files"][index].get("sha256")
+            if len(photo) != session["files"][index]["size"] or \
+                    (expected and hashlib.sha256(photo).hexdigest() != expected):
+                shutil.rmtree(self.path(upload_id, str(index)), ignore_errors=True)
+                raise ValueError("photo does not match its size / sha256, send it again")
+            write_atomic(self.photo_path(upload_id, index), photo)
+            shutil.rmtree(self.path(upload_id, str(index)), ignore_errors=True)
+        finally:
+            self.release(upload_id, lock)
+        self.assembled += 1
+        return photo
+
+    def start_detection(self, upload_id, session, index, photo):
+        # the pool may be full; then this photo is simply detected in finish()
+        if PRESENCE_MODE or not DETECTION_POOL.reserve(1):
+            return
+        meta = session["meta"]
+        devices = MANIFESTS.devices_for(meta["vehicle_type"], meta["vehicle_id"])
+
+        async def detect():
+            try:
+                rois = await asyncio.to_thread(last_positions, meta["vehicle_id"]) if ROI_SEARCH else None
+                result = await DETECTION_POOL.run(inspect_image, photo, (), devices, rois, meta["vehicle_id"],
+                                                  meta.get("scales", [1.0] * (index + 1))[index])
+            finally:
+                DETECTION_POOL.release(1)
+            # kept next to the photo: finish() may run on another worker
+            await asyncio.to_thread(write_atomic, self.result_path(upload_id, index), pickle.dumps(result))
+            return result
+
+        task = self._detections[(upload_id, index)] = spawn(detect())
+        task.add_done_callback(lambda _: self._detections.pop((upload_id, index), None))
+        self.started_early += 1
+
+    def stored_detection(self, upload_id, index):
+        # an early detection finished by this or another worker, as an already completed future
+        try:
+            with open(self.result_path(upload_id, index), "rb") as f:
+                result = pickle.load(f)
+        except (OSError, pickle.UnpicklingError, EOFError):
+            return None
+        done = asyncio.get_running_loop().create_future()
+        done.set_result(result)
+        return done
+
+    def record_id(self, upload_id):
+        try:
+            with open(self.path(upload_id, "done.json"), encoding="utf-8") as f:
+                return json.load(f)["record_id"]
+        except (OSError, ValueError):
+            return None
+
+    async def finish(self, upload_id, session):
+        # idempotent: a client that lost the answer calls again and gets the same record, on any worker.
+        # the worker holding finish.lock saves it; the others wait for its done.json
+        while True:
+            record_id = self.record_id(upload_id)
+            if record_id is not None:
+                return record_id
+            task = self._finishing.get(upload_id)
+            if task is None and self.claim(upload_id, "finish"):
+                task = self._finishing[upload_id] = spawn(self._finish(upload_id, session))
+                task.add_done_callback(lambda _: self._finishing.pop(upload_id, None))
+            if task is not None:
+                return await asyncio.shield(task)
+            if self.load(upload_id) is None:
+                return None    # swept while waiting
+            await asyncio.sleep(0.5)
+
+    async def _finish(self, upload_id, session):
+        # the lock stays after success (done.json answers from then on); a failed finish can be retried
+        heartbeat = spawn(self.keep_claim(upload_id, "finish"))
+        try:
+            record_id = self.record_id(upload_id)
+            if record_id is None:
+                record_id = await self._save(upload_id, session)
+        except BaseException:
+            self.release(upload_id, "finish")
+            raise
+        finally:
+            heartbeat.cancel()
+        return record_id
+
+    async def _save(self, upload_id, session):
+        uploads = []
+        for index in range(len(session["files"])):
+            with open(self.photo_path(upload_id, index), "rb") as f:
+                uploads.append(f.read())
+        started = {}
+        for index in range(len(uploads)):
+            task = self._detections.pop((upload_id, index), None) or self.stored_detection(upload_id, index)
+            if task is not None:
+                started[index] = task
+        late = len(uploads) - len(started)
+        DETECTION_POOL.reserve(late, force=True)
+        try:
+            saved = await inspect_and_record(session["meta"], [spec["name"] for spec in session["files"]], uploads,
+                                             emit=noop_emit, started=started)
+            record_id = await asyncio.wrap_future(saved)
+        finally:
+            DETECTION_POOL.release(late)
+        write_atomic(self.path(upload_id, "done.json"), json.dumps({"record_id": record_id}).encode("utf-8"))
+        for index in range(len(uploads)):
+            for path in (self.photo_path(upload_id, index), self.result_path(upload_id, index)):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+        self.finished += 1
+        return record_id
+
+    def sweep(self):
+        # drops sessions nobody finished (or that finished long ago)
+        if not os.path.isdir(self.folder):
+            return
+        cutoff = time.time() - UPLOAD_SESSION_TTL
+        expired = set()
+        for entry in os.scandir(self.folder):
+            try:
+                if entry.is_dir() and os.stat(os.path.join(entry.path, "session.json")).st_mtime < cutoff:
+                    expired.add(entry.name)
+            except OSError:
+                expired.add(entry.name)
+        for upload_id in expired:
+            shutil.rmtree(self.path(upload_id), ignore_errors=True)
+        for key in [key for key in self._detections if key[0] in expired]:
+            self._detections.pop(key).cancel()
+
+    def stats(self):
+        return {
+            "created": self.created,
+            "chunks": self.chunks,
+            "rejected_chunks": self.rejected_chunks,
+            "assembled": self.assembled,
+            "started_early": self.started_early,
+            "finished": self.finished,
+            "active": len(self._detections) + len(self._finishing),
+        }
+
+
+UPLOADS = UploadSessions()
+
+
+async def noop_emit(card):
+    pass
+
+
+def upload_session(request, upload_id):
+    # sessions belong to the crew member who created them
+    session = UPLOADS.load(upload_id)
+    if session is None or session["meta"]["username"] != request.session.get("user"):
+        return None
+    return session
+
+
+@app.post("/api/uploads")
+async def create_upload(request: Request):
+    # {"vehicle_type", "vehicle_id", "files": [{"name", "size", "sha256" (optional), "scale" (optional)}]}
+    if not request.session.get("user"):
+        return RedirectResponse(url="/")
+    try:
+        body = await request.json()
+        files = [{"name": str(f["name"]), "size": int(f["size"]), "sha256": f.get("sha256")} for f in body["files"]]
+        meta = {"division": request.session["division"], "username": request.session["user"],
+                "vehicle_type": str(body["vehicle_type"]), "vehicle_id": str(body["vehicle_id"]),
+                "scales": photo_scales([f.get("scale") for f in body["files"]], len(files))}
+    except (ValueError, KeyError, TypeError):
+        return JSONResponse({"error": "invalid upload request"}, status_code=400)
+    if not 1 <= len(files) <= MAX_UPLOAD:
+        return JSONResponse({"error": "最多上傳 {} 張圖片".format(MAX_UPLOAD)}, status_code=400)
+    if any(not 0 < f["size"] <= UPLOAD_MAX_BYTES for f in files):
+        return JSONResponse({"error": "照片大小不符"}, status_code=400)
+    if not TEMPLATE_STORE.get().templates:
+        return JSONResponse({"error": "templates 資料夾中沒有模板圖片"}, status_code=409)
+    upload_id = await asyncio.to_thread(UPLOADS.create, meta, files)
+    return JSONResponse(UPLOADS.status(upload_id, UPLOADS.load(upload_id)), status_code=201)
+
+
+@app.get("/api/uploads/{upload_id}")
+async def upload_status(request: Request, upload_id: str):
+    # which chunks the server already has, so a client can resume
+    if not request.session.get("user"):
+        return RedirectResponse(url="/")
+    session = upload_session(request, upload_id)
+    if session is None:
+        return JSONResponse({"error": "upload not found"}, status_code=404)
+    return UPLOADS.status(upload_id, session)
+
+
+@app.put("/api/uploads/{upload_id}/{index}/{n}")
+async def upload_chunk(request: Request, upload_id: str, index: int, n: int):
+    # body is the raw chunk; X-Chunk-CRC32 or X-Chunk-SHA256 (hex) is checked before it is stored
+    if not request.session.get("user"):
+        return RedirectResponse(url="/")
+    session = upload_session(request, upload_id)
+    if session is None:
+        return JSONResponse({"error": "upload not found"}, status_code=404)
+    if not 0 <= index < len(session["files"]) or not 0 <= n < UPLOADS.chunk_count(session, index):
+        return JSONResponse({"error": "chunk out of range"}, status_code=400)
+    data = await request.body()
+    size = session["files"][index]["size"]
+    if len(data) != min(session["chunk_size"], size - n * session["chunk_size"]):
+        UPLOADS.rejected_chunks += 1
+        return JSONResponse({"error": "chunk size mismatch"}, status_code=400)
+    crc = request.headers.get("x-chunk-crc32")
+    sha = request.headers.get("x-chunk-sha256")
+    if crc is None and sha is None:
+        return JSONResponse({"error": "X-Chunk-CRC32 or X-Chunk-SHA256 header required"}, status_code=400)
+    if (crc is not None and crc.lower() != "{:08x}".format(zlib.crc32(data))) or \
+            (sha is not None and sha.lower() != hashlib.sha256(data).hexdigest()):
+        UPLOADS.rejected_chunks += 1
+        return JSONResponse({"error": "checksum mismatch"}, status_code=422)
+    if os.path.exists(UPLOADS.photo_path(upload_id, index)):
+        return {"index": index, "chunk": n, "complete": True}    # a resend after a lost answer
+    try:
+        photo = await asyncio.to_thread(UPLOADS.put_chunk, upload_id, session, index, n, data)
+    except ValueError as e:
+        return JSONResponse({"error": str(e)}, status_code=422)
+    if photo is not None:
+        UPLOADS.start_detection(upload_id, session, index, photo)
+    return {"index": index, "chunk": n, "complete": photo is not None}
+
+
+@app.post("/api/uploads/{upload_id}/finish")
+async def finish_upload(request: Request, upload_id: str):
+    if not request.session.get("user"):
+        return RedirectResponse(url="/")
+    session = upload_session(request, upload_id)
+    if session is None:
+        return JSONResponse({"error": "upload not found"}, status_code=404)
+    status = UPLOADS.status(upload_id, session)
+    if status["record_id"] is None and not all(f["complete"] for f in status["files"]):
+        return JSONResponse(dict(status, error="照片尚未上傳完成"), status_code=409)
+    record_id = await UPLOADS.finish(upload_id, session)
+    if record_id is None:
+        return JSONResponse({"error": "upload not found"}, status_code=404)
+    return {"record_id": record_id, "page_url": "/records/{}".format(record_id)}
+
+
+@app.get("/preview/{pid}")
+async def preview(request: Request, pid: str, size: str = "full"):
+    if not request.session.get("user"):
+        return RedirectResponse(url="/")
+    if not PREVIEW_ID.fullmatch(pid) or (size != "full" and size not in PREVIEW_SIZES):
+        return Response(status_code=404)
+
+    etag = '"{}-{}"'.format(pid, size)
+    headers = {"Cache-Control": "private, max-age=31536000, immutable", "ETag": etag}
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+
+    path = await asyncio.to_thread(preview_file, pid, size)
+    if path is None:
+        return Response(status_code=404)
+    return FileResponse(path, media_type="image/jpeg", headers=headers)
+
+
+@read_op
+def compliance_rows(c, device, filters):
+    # per vehicle: inspections that checked the device, and how many found it in no photo
+    where, params = filter_clauses(filters)
+    sql = """
+        WITH r AS (
+            SELECT id, vehicle_id, timestamp FROM records {}
+        ), per_record AS (
+            SELECT r.id, r.vehicle_id, r.timestamp, MAX(d.detected) = 0 AS missing
+            FROM r JOIN detections d ON d.record_id = r.id AND d.device = ?
+            GROUP BY r.id
+        )
+        SELECT vehicle_id, COUNT(*), SUM(missing), MAX(CASE WHEN missing THEN timestamp END)
+        FROM per_record GROUP BY vehicle_id ORDER BY SUM(missing) DESC, vehicle_id
+    """.format("WHERE " + " AND ".join(where) if where else "")
+    return c.execute(sql, params + [device]).fetchall()
+
+
+def compliance_summary(device, filters):
+    with db_timer("compliance"):
+        rows = read("compliance_rows", device, filters)
+    return [
+        {"vehicle_id": vid, "inspections": total, "missing": missing, "last_missing": last}
+        for vid, total, missing, last in rows
+    ]
+
+
+def record_filters(division, vehicle_type, vehicle_id, username, since, until):
+    filters = {"division": division, "vehicle_type": vehicle_type, "vehicle_id": vehicle_id,
+               "username": username, "since": since, "until": until}
+    return {key: value.strip() for key, value in filters.items() if value and value.strip()}
+
+
+@app.get("/api/records")
+async def records_api(request: Request, division: Optional[str] = None, vehicle_type: Optional[str] = None,
+                      vehicle_id: Optional[str] = None, username: Optional[str] = None,
+                      since: Optional[str] = None, until: Optional[str] = None,
+                      before: Optional[int] = None, limit: int = RECORDS_PAGE_SIZE,
+                      include_results: bool = False):
+    if not request.session.get("user"):
+        return RedirectResponse(url="/")
+
+    filters = record_filters(division, vehicle_type, vehicle_id, username, since, until)
+    limit = max(1, min(limit, RECORDS_PAGE_MAX))
+    rows, next_before = await asyncio.to_thread(query_records, filters, before, limit, include_results)
+
+    records = []
+    for row in rows:
+        record = dict(zip(RECORD_COLUMNS, row))
+        if record["missing"] is not None:
+            record["missing"] = json.loads(record["missing"])
+        record["reused"] = json.loads(record["reused"]) if record["reused"] else []
+        if include_results:
+            record["results"] = json.loads(row[-1]) if row[-1] else {}
+        records.append(record)
+    return {"records": records, "next_before": next_before}
+
+
+@app.get("/api/compliance")
+async def compliance_api(request: Request, device: str, division: Optional[str] = None,
+                         vehicle_type: Optional[str] = None, vehicle_id: Optional[str] = None,
+                         since: Optional[str] = None, until: Optional[str] = None):
+    if not request.session.get("user"):
+        return RedirectResponse(url="/")
+    filters = record_filters(division, vehicle_type, vehicle_id, None, since, until)
+    vehicles = await asyncio.to_thread(compliance_summary, device, filters)
+    return {"device": device, "vehicles": vehicles,
+            "missing_vehicles": [v["vehicle_id"] for v in vehicles if v["missing"]]}
+
+
+RECORDS_PAGE = Page("""
+      <div class="container">
+        <h2>📚 近期檢查紀錄</h2>
+        <a href="/upload_form">返回</a>
+        <form method='get' action='/records' class='filters'>{fields}<button type='submit'>篩選</button></form>
+        <table style="margin-top:12px; width:100%; border-collapse:collapse;">
+          <thead><tr style="background:#eef3ff"><th>ID</th><th>時間</th><th>分隊</th><th>隊員</th><th>車種</th><th>車號</th><th>缺少設備</th></tr></thead>
+          <tbody>{rows}</tbody>
+        </table>
+        <div style="text-align:right; margin-top:8px;">{more}</div>
+      </div>
+""")
+RECORD_ROW = Page("<tr><td><a href='/records/{id}'>{id}</a>{reused}</td><td>{timestamp}</td><td>{division}</td>"
+                  "<td>{username}</td><td>{vehicle_type}</td><td>{vehicle_id}</td><td>{missing}</td></tr>")
+RECORDS_EMPTY = Markup("<tr><td colspan='7'>沒有紀錄</td></tr>")
+RECORDS_MORE = Page("<a href='/records?{query}'>下一頁 ›</a>")
+REUSED_MARK = Markup(" <span title='疑似重複使用的照片'>⚠</span>")
+RECORD_FILTER_FIELD = Page("<input type='text' name='{name}' placeholder='{placeholder}' value='{value}'>")
+RECORD_FILTER_FIELDS = [("division", "分隊"), ("username", "隊員"), ("vehicle_type", "車種"), ("vehicle_id", "車號"),
+                        ("since", "起 (YYYY-MM-DD)"), ("until", "迄 (YYYY-MM-DD，含當日)")]
+
+
+@app.get("/records", response_class=HTMLResponse)
+async def records_page(request: Request, division: Optional[str] = None, vehicle_type: Optional[str] = None,
+                       vehicle_id: Optional[str] = None, username: Optional[str] = None,
+                       since: Optional[str] = None, until: Optional[str] = None,
+                       before: Optional[int] = None):
+    if not request.session.get("user"):
+        return RedirectResponse(url="/")
+
+    filters = record_filters(division, vehicle_type, vehicle_id, username, since, until)
+    rows, next_before = await asyncio.to_thread(query_records, filters, before)
+
+    def missing_cell(value):
+        if value is None:
+            return ""
+        missing = json.loads(value)
+        return "✘ " + "、".join(missing) if missing else "✔"
+
+    body = RECORD_ROW.render_all(
+        {"id": r[0], "timestamp": r[1], "division": r[2], "username": r[3], "vehicle_type": r[4],
+         "vehicle_id": r[5], "missing": missing_cell(r[6]), "reused": REUSED_MARK if r[7] else ""}
+        for r in rows
+    ) or RECORDS_EMPTY
+
+    more = ""
+    if next_before is not None:
+        more = RECORDS_MORE.render(query=urlencode(dict(filters, before=next_before)))
+
+    fields = RECORD_FILTER_FIELD.render_all({"name": name, "placeholder": placeholder, "value": filters.get(name, "")}
+                                            for name, placeholder in RECORD_FILTER_FIELDS)
+    page = page_head("紀錄") + RECORDS_PAGE.render(fields=fields, rows=body, more=more) + PAGE_TAIL
+    return HTMLResponse(page)
+
+
+RECORD_SUMMARY = Page("<p>#{id} &nbsp; {timestamp} &nbsp; {division} / {username} &nbsp; {vehicle_type} {vehicle_id}</p>")
+RECORD_STATE = Page("<p>{state}</p>")
+RECORD_REUSED = Page("<p style='color:#8a6d00'>⚠ 疑似重複使用的照片：{items}</p>")
+REUSED_ITEM = Page("{image} (<a href='/records/{record_id}'>紀錄 #{record_id}</a> {previous})")
+
+
+@read_op
+def get_record(c, record_id):
+    # (record row, {image: preview id}) or None
+    row = c.execute(
+        "SELECT {}, results FROM records WHERE id = ?".format(", ".join(RECORD_COLUMNS)), (record_id,)
+    ).fetchone()
+    if row is None:
+        return None
+    previews = c.execute(
+        "SELECT image, preview FROM photos WHERE record_id = ? AND preview IS NOT NULL", (record_id,)
+    ).fetchall()
+    return row, dict(previews)
+
+
+def live_preview(pid):
+    # records outlive their previews (PREVIEW_RETENTION_DAYS); expired ones are left out of the card
+    return pid if pid and os.path.exists(preview_path(pid)) else None
+
+
+@app.get("/records/{record_id}", response_class=HTMLResponse)
+async def record_page(request: Request, record_id: int):
+    if not request.session.get("user"):
+        return RedirectResponse(url="/")
+    # off the event loop: with a record-server this is a network round trip
+    found = await asyncio.to_thread(read, "get_record", record_id)
+    if found is None:
+        return HTMLResponse("<h3>❌ 找不到此紀錄</h3>", status_code=404)
+    row, previews = found
+    record = dict(zip(RECORD_COLUMNS, row))
+
+    summary = RECORD_SUMMARY.render(**{name: record[name] or "" for name in RECORD_COLUMNS})
+    cards = "".join(
+        render_card(idx, filename, live_preview(previews.get(filename)), device_res)
+        for idx, (filename, device_res) in enumerate(json.loads(row[-1] or "{}").items(), start=1)
+    )
+    if record["missing"] is not None:
+        missing = json.loads(record["missing"])
+        state = "✘ 缺少設備：" + "、".join(missing) if missing else "✔ 應備設備皆已偵測到"
+        summary += RECORD_STATE.render(state=state)
+    if record["reused"]:
+        summary += RECORD_REUSED.render(items=Markup("、".join(REUSED_ITEM.render_all(
+            {"image": item["image"] or "", "record_id": item["record_id"], "previous": item["previous_image"] or ""}
+            for item in json.loads(record["reused"])
+        ))))
+    return HTMLResponse(RESULT_PAGE_HEAD + summary + cards + RESULT_PAGE_TAIL)
+
+
+@app.get("/admin/templates")
+async def template_stats(request: Request):
+    if not request.session.get("user"):
+        return RedirectResponse(url="/")
+    TEMPLATE_STORE.get()    # picks up a reload done by another worker
+    return TEMPLATE_STORE.stats()
+
+
+@app.post("/admin/templates/reload")
+async def reload_templates(request: Request, token: Optional[str] = None):
+    if not request.session.get("user"):
+        return RedirectResponse(url="/")
+    # anyone can log in, so swapping the templates of every worker needs the admin token as well
+    if not (ADMIN_TOKEN and hmac.compare_digest(token or "", ADMIN_TOKEN)):
+        return JSONResponse({"error": "forbidden"}, status_code=403)
+    TEMPLATE_STORE.reload()
+    return TEMPLATE_STORE.stats()
+
+
+@app.get("/admin/stats")
+async def admin_stats(request: Request):
+    if not request.session.get("user"):
+        return RedirectResponse(url="/")
+    return {
+        "templates": TEMPLATE_STORE.stats(),
+        "pool": DETECTION_POOL.stats(),
+        "db_writer": RECORD_WRITER.stats(),
+        "engine": MATCH_ENGINE,
+        "pyramid_parity": PYRAMID_PARITY.stats(),
+        "fft_parity": FFT_PARITY.stats(),
+        "presence": PRESENCE_STATS.stats(),
+        "jobs": JOBS.stats(),
+        "uploads": UPLOADS.stats(),
+        "result_cache": RESULT_CACHE.stats(),
+        "previews": PREVIEW_SWEEPER.stats(),
+        "variants": VARIANT_STATS.stats(),
+        "roi": ROI_STATS.stats(),
+    }
+
+
+@app.get("/metrics")
+async def metrics(request: Request, token: Optional[str] = None):
+    if not request.session.get("user") and not (METRICS_TOKEN and token == METRICS_TOKEN):
+        return RedirectResponse(url="/")
+    pool = DETECTION_POOL.stats()
+    jobs = JOBS.stats()
+    cache = RESULT_CACHE.stats()
+    gauges = [
+        ("emsch_pool_pending", pool["pending"]),
+        ("emsch_pool_rejected_total", pool["rejected"]),
+        ("emsch_jobs_queued", jobs["queued"]),
+        ("emsch_db_writer_written_total", RECORD_WRITER.written),
+        ("emsch_db_writer_failed_total", RECORD_WRITER.failed),
+        ("emsch_result_cache_hits_total", cache["exact_hits"]),
+        ("emsch_result_cache_misses_total", cache["misses"]),
+        ("emsch_template_version", TEMPLATE_STORE.get().version),
+        ("emsch_roi_tried_total", ROI_STATS.tried),
+        ("emsch_roi_hits_total", ROI_STATS.hits),
+    ]
+    return Response(METRICS.render(gauges), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+# ---------- benchmark ----------
+def synthetic_scene(template_set, rng, size, scale_range, noise, max_tilt=0.0):
+    # textured background with one template per chosen device pasted at a known place;
+    # returns the JPEG bytes and {device: (x, y, w, h)} in photo coordinates
+    height, width = size * 3 // 4, size
+    coarse = rng.integers(60, 200, (max(height // 64, 2), max(width // 64, 2)), dtype=np.uint8)
+    scene = cv2.resize(coarse, (width, height), interpolation=cv2.INTER_CUBIC).astype(np.float32)
+    scene += rng.normal(0, 6, scene.shape)
+
+    # templates were cropped from TEMPLATE_REF_SIDE photos, so a smaller photo shows them smaller.
+    # the scenes depend only on the arguments, never on the config under test
+    base = size / TEMPLATE_REF_SIDE
+    devices = sorted(template_set.devices)
+    chosen = rng.choice(len(devices), size=rng.integers(1, len(devices) + 1), replace=False)
+    truth = {}
+    taken = []
+    for i in sorted(chosen):
+        device = devices[i]
+        tlist = template_set.devices[device]
+        _, tmpl = tlist[rng.integers(len(tlist))]
+        scale = base * rng.uniform(*scale_range)
+        h, w = max(int(tmpl.shape[0] * scale), 1), max(int(tmpl.shape[1] * scale), 1)
+        if h >= height or w >= width:
+            continue
+        patch = cv2.resize(tmpl, (w, h), interpolation=cv2.INTER_AREA if scale < 1 else cv2.INTER_LINEAR)
+        mask = np.ones_like(patch)
+        if max_tilt:
+            # tilted copy on a larger canvas; the mask keeps the corners of the background
+            rotation = cv2.getRotationMatrix2D((w / 2, h / 2), rng.uniform(-max_tilt, max_tilt), 1)
+            cos, sin = abs(rotation[0, 0]), abs(rotation[0, 1])
+            nw, nh = int(h * sin + w * cos), int(h * cos + w * sin)
+            rotation[0, 2] += nw / 2 - w / 2
+            rotation[1, 2] += nh / 2 - h / 2
+            patch = cv2.warpAffine(patch, rotation, (nw, nh))
+            mask = cv2.warpAffine(mask, rotation, (nw, nh), flags=cv2.INTER_NEAREST)
+            h, w = nh, nw
+            if h >= height or w >= width:
+                continue
+        for _ in range(50):
+            x, y = int(rng.integers(0, width - w)), int(rng.integers(0, height - h))
+            if all(x + w <= bx or bx + bw <= x or y + h <= by or by + bh <= y for bx, by, bw, bh in taken):
+                region = scene[y:y + h, x:x + w]
+                region[mask > 0] = patch[mask > 0]
+                taken.append((x, y, w, h))
+                truth[device] = (x, y, w, h)
+                break
+
+    if noise:
+        scene += rng.normal(0, noise, scene.shape)
+    img = cv2.cvtColor(np.clip(scene, 0, 255).astype(np.uint8), cv2.COLOR_GRAY2BGR)
+    ok, buf = cv2.imencode(".jpg", img, [cv2.IMWRITE_JPEG_QUALITY, 90])
+    return buf.tobytes(), truth
+
+
+def grown_library(template_set, factor):
+    # the same templates repeated under new names, to see how cost grows with the library
+    if factor <= 1:
+        return template_set
+    templates = dict(template_set.templates)
+    for copy in range(2, factor + 1):
+        templates.update({"{}~{}".format(name, copy): img for name, img in template_set.templates.items()})
+    return TemplateSet(templates, template_set.version)
+
+
+def box_iou(a, b):
+    ax, ay, aw, ah = a
+    bx, by, bw, bh = b
+    iw = max(0, min(ax + aw, bx + bw) - max(ax, bx))
+    ih = max(0, min(ay + ah, by + bh) - max(ay, by))
+    inter = iw * ih
+    return inter / float(aw * ah + bw * bh - inter)
+
+
+def bench_run(template_set, size, images, scale_range, noise, seed, max_tilt=0.0):
+    rng = np.random.default_rng(seed)
+    scenes = [synthetic_scene(TEMPLATE_STORE.get(), rng, size, scale_range, noise, max_tilt) for _ in range(images)]
+    work_scale = WORK_MAX_SIDE / size if WORK_MAX_SIDE else 1.0
+    tp = fp = fn = 0
+    latencies = []
+
+    # same path as upload() minus the preview: decode, grayscale, match
+    templates = working_templates(template_set)
+    detect_image(cv2.cvtColor(load_image(scenes[0][0]), cv2.COLOR_BGR2GRAY), templates)    # warm-up
+    started = time.perf_counter()
+    for data, truth in scenes:
+        t0 = time.perf_counter()
+        gray = cv2.cvtColor(load_image(data), cv2.COLOR_BGR2GRAY)
+        device_res, best_boxes = detect_image(gray, templates)
+        latencies.append(time.perf_counter() - t0)
+
+        for device, info in device_res.items():
+            expected = truth.get(device)
+            if not info["detected"]:
+                fn += expected is not None
+                continue
+            (x1, y1), (x2, y2), _ = best_boxes.get(device, ((0, 0), (0, 0), 0))
+            found = (x1 / work_scale, y1 / work_scale, (x2 - x1) / work_scale, (y2 - y1) / work_scale)
+            if expected is not None and box_iou(found, expected) >= 0.5:
+                tp += 1
+            else:
+                fp += 1
+                fn += expected is not None
+    elapsed = time.perf_counter() - started
+
+    # memory in a second, untimed pass: tracemalloc slows every allocation down
+    tracemalloc.start()
+    for data, _ in scenes:
+        detect_image(cv2.cvtColor(load_image(data), cv2.COLOR_BGR2GRAY), templates)
+    _, traced_peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    ms = np.array(latencies) * 1000
+    return {
+        "size": size,
+        "templates": len(template_set.templates),
+        "images": images,
+        "throughput_ips": round(images / elapsed, 3),
+        "latency_ms": {"p50": round(float(np.percentile(ms, 50)), 2), "p95": round(float(np.percentile(ms, 95)), 2),
+                       "mean": round(float(ms.mean()), 2), "max": round(float(ms.max()), 2)},
+        "peak_traced_mb": round(traced_peak / 2 ** 20, 1),
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1) if resource else None,
+        "tp": tp,
+        "fp": fp,
+        "fn": fn,
+        "precision": round(tp / (tp + fp), 4) if tp + fp else None,
+        "recall": round(tp / (tp + fn), 4) if tp + fn else None,
+    }
+
+
+def run_benchmark(sizes, libraries, images, scale_range, noise, seed, max_tilt=0.0):
+    template_set = TEMPLATE_STORE.get()
+    if not template_set.templates:
+        raise SystemExit("no templates in " + TEMPLATE_DIR)
+    runs = []
+    for factor in libraries:
+        library = grown_library(template_set, factor)
+        for size in sizes:
+            runs.append(bench_run(library, size, images, scale_range, noise, seed, max_tilt))
+    config = {
+        "engine": MATCH_ENGINE, "threshold": THRESHOLD, "presence_mode": PRESENCE_MODE,
+        "work_max_side": WORK_MAX_SIDE, "match_workers": MATCH_WORKERS,
+        "match_scales": list(MATCH_SCALES), "match_rotations": list(MATCH_ROTATIONS),
+        "scale_range": list(scale_range), "tilt": max_tilt, "noise": noise, "seed": seed,
+    }
+    return {"config": config, "runs": runs}
+
+
+# ---------- record server ----------
+def record_server_app():
+    # serves DB_PATH to app workers started with EMSCH_RECORD_STORE=http://host:port;
+    # reads only as READ_OPS on query_only connections, writes only as WRITE_OPS on this process's writer
+    if not RECORD_STORE_TOKEN:
+        raise SystemExit("set EMSCH_RECORD_TOKEN (the same value on the record server and every app worker)")
+    store = FastAPI()
+
+    def authorized(request):
+        return hmac.compare_digest(request.headers.get("authorization", ""), "Bearer " + RECORD_STORE_TOKEN)
+
+    @store.post("/read")
+    def read_records(request: Request, payload: dict):
+        if not authorized(request):
+            return JSONResponse({"error": "forbidden"}, status_code=403)
+        if payload.get("op") not in READ_OPS:
+            return JSONResponse({"error": "unknown op"}, status_code=400)
+        try:
+            result = READ_OPS[payload["op"]](db(), *payload.get("args", []))
+        except (sqlite3.Error, TypeError) as e:
+            return JSONResponse({"error": str(e)}, status_code=400)
+        return {"result": result}
+
+    @store.post("/write")
+    def write(request: Request, payload: dict):
+        if not authorized(request):
+            return JSONResponse({"error": "forbidden"}, status_code=403)
+        if payload.get("op") not in WRITE_OPS:
+            return JSONResponse({"error": "unknown op"}, status_code=400)
+        try:
+            result = RECORD_WRITER.write(payload["op"], *payload.get("args", [])).result()
+        except Exception as e:
+            log.exception("record server write %s failed", payload["op"])
+            return JSONResponse({"error": str(e)}, status_code=500)
+        return {"result": result}
+
+    @store.get("/health")
+    def health():
+        return {"writer": RECORD_WRITER.stats(), "pid": os.getpid()}
+
+    return store
+
+
+# ---------- load test ----------
+def http_call(base, method, path, body=None, headers=None):
+    url = urlsplit(base)
+    conn = http.client.HTTPConnection(url.hostname, url.port or 80, timeout=300)
+    try:
+        conn.request(method, path, body, headers or {})
+        response = conn.getresponse()
+        return response.status, response.getheaders(), response.read()
+    finally:
+        conn.close()
+
+
+def multipart_body(fields, files):
+    boundary = uuid.uuid4().hex
+    parts = []
+    for name, value in fields.items():
+        parts.append('--{}\r\nContent-Disposition: form-data; name="{}"\r\n\r\n{}\r\n'.format(
+            boundary, name, value).encode("utf-8"))
+    for name, filename, data in files:
+        parts.append('--{}\r\nContent-Disposition: form-data; name="{}"; filename="{}"\r\n'
+                     'Content-Type: image/jpeg\r\n\r\n'.format(boundary, name, filename).encode("utf-8"))
+        parts.append(data + b"\r\n")
+    parts.append("--{}--\r\n".format(boundary).encode("utf-8"))
+    return b"".join(parts), "multipart/form-data; boundary=" + boundary
+
+
+def load_round(base, uploads, concurrency):
+    # logs in once and sends every upload (a list of photos each) from `concurrency` threads;
+    # 503 counts as busy, not as an error
+    _, headers, _ = http_call(base, "POST", "/login", urlencode({"division": "loadtest", "username": "loadtest"}),
+                              {"Content-Type": "application/x-www-form-urlencoded"})
+    cookie = "; ".join(value.split(";")[0] for name, value in headers if name.lower() == "set-cookie")
+
+    def one(photos):
+        body, content_type = multipart_body(
+            {"vehicle_type": "救護車", "vehicle_id": "LOADTEST"},
+            [("files", "photo{}.jpg".format(idx), data) for idx, data in enumerate(photos)],
+        )
+        start = time.perf_counter()
+        try:
+            status, _, _ = http_call(base, "POST", "/upload", body, {"Content-Type": content_type, "Cookie": cookie})
+        except OSError:
+            status = None
+        return status, time.perf_counter() - start
+
+    total = len(uploads)
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(one, uploads))
+    elapsed = time.perf_counter() - start
+    ms = np.array([seconds * 1000 for status, seconds in results if status == 200] or [0.0])
+    ok = sum(1 for status, _ in results if status == 200)
+    return {
+        "requests": total,
+        "ok": ok,
+        "busy": sum(1 for status, _ in results if status == 503),
+        "errors": sum(1 for status, _ in results if status not in (200, 503)),
+        "seconds": round(elapsed, 3),
+        "throughput_rps": round(ok / elapsed, 3),
+        "latency_ms": {"p50": round(float(np.percentile(ms, 50)), 2), "p95": round(float(np.percentile(ms, 95)), 2)},
+    }
+
+
+def start_workers(workers, port):
+    # uvicorn imports this file as a module, so its name has to be a valid identifier (see README)
+    module = os.path.splitext(os.path.basename(__file__))[0]
+    if not module.isidentifier():
+        raise SystemExit("rename {} to an importable name (e.g. emsch.py) or pass --url".format(os.path.basename(__file__)))
+    proc = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", module + ":app", "--host", "127.0.0.1", "--port", str(port),
+         "--workers", str(workers), "--log-level", "warning"],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+    )
+    base = "http://127.0.0.1:{}".format(port)
+    deadline = time.monotonic() + 120
+    while time.monotonic() < deadline:
+        try:
+            if http_call(base, "GET", "/")[0] == 200:
+                return proc, base
+        except OSError:
+            pass
+        if proc.poll() is not None:
+            raise SystemExit("uvicorn exited with code {}".format(proc.returncode))
+        time.sleep(0.5)
+    proc.terminate()
+    raise SystemExit("uvicorn did not start within 120s")
+
+
+def run_loadtest(url, worker_counts, total, concurrency, photos, size, port):
+    template_set = TEMPLATE_STORE.get()
+    rng = np.random.default_rng(int(time.time()))
+
+    def scenes(count):
+        # fresh scenes every round, otherwise the result cache answers from the second request on
+        return [[synthetic_scene(template_set, rng, size, (1.0, 1.0), 4.0)[0] for _ in range(photos)]
+                for _ in range(count)]
+
+    runs = []
+    if url:
+        runs.append(dict(load_round(url, scenes(total), concurrency), url=url))
+    for workers in worker_counts if not url else ():
+        proc, base = start_workers(workers, port)
+        try:
+            load_round(base, scenes(min(concurrency, total)), concurrency)    # warm-up: templates, pools
+            runs.append(dict(load_round(base, scenes(total), concurrency), workers=workers))
+        finally:
+            proc.terminate()
+            proc.wait(30)
+    config = {"requests": total, "concurrency": concurrency, "photos": photos, "size": size,
+              "engine": MATCH_ENGINE, "templates": len(template_set.templates), "record_store": RECORD_STORE,
+              "cpus": os.cpu_count()}
+    return {"config": config, "runs": runs}
+
+
+# init database (a record-server owns it when RECORD_STORE is a URL)
+if RECORD_STORE == "sqlite":
+    init_db()
+# load templates once at startup
+TEMPLATE_STORE.get()
 
-    if body == "":
-        body = "<tr><td colspan='6'>沒有紀錄</td></tr>"
-
-    page = """
-    <html><head>
-      <meta name="viewport" content="width=device-width, initial-scale=1">
-      <title>紀錄</title>
-      <style>
-        body{font-family:Arial; background:#f4f7fb; padding:18px}
-        .container{max-width:900px; margin:0 auto}
-      </style>
-    </head>
-    <body>
-      <div class="container">
-        <h2>📚 近期檢查紀錄</h2>
-        <a href="/upload_form">返回</a>
-        <table style="margin-top:12px; width:100%; border-collapse:collapse;">
-          <thead><tr style="background:#eef3ff"><th>ID</th><th>時間</th><th>分隊</th><th>隊員</th><th>車種</th><th>車號</th></tr></thead>
-          <tbody>""" + body + """</tbody>
-        </table>
-      </div>
-    </body>
-    </html>
-    """
-    return HTMLResponse(page)
 
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="EMSCH maintenance commands")
+    commands = parser.add_subparsers(dest="command", required=True)
+    backfill = commands.add_parser("backfill-detections", help="fill the detections table from records.results")
+    backfill.add_argument("--batch", type=int, default=500)
+    commands.add_parser("build-index", help="compile templates/ into " + (TEMPLATE_INDEX_PATH or "a template index"))
+    bench = commands.add_parser("bench", help="time detection on synthetic scenes built from templates/, prints JSON")
+    bench.add_argument("--images", type=int, default=20)
+    bench.add_argument("--sizes", type=int, nargs="+", default=[1600], help="photo widths in pixels")
+    bench.add_argument("--library", type=int, nargs="+", default=[1], help="template library multipliers")
+    bench.add_argument("--scale", type=float, nargs=2, default=[1.0, 1.0], metavar=("MIN", "MAX"))
+    bench.add_argument("--tilt", type=float, default=0.0, help="templates are pasted tilted up to this many degrees")
+    bench.add_argument("--noise", type=float, default=4.0, help="gaussian noise sigma")
+    bench.add_argument("--seed", type=int, default=0)
+    bench.add_argument("--engine", choices=["exhaustive", "pyramid", "fft", "orb"], help="override MATCH_ENGINE")
+    bench.add_argument("--threshold", type=float, help="override THRESHOLD for this run")
+    bench.add_argument("--match-scales", type=float, nargs="+", help="override MATCH_SCALES for this run")
+    bench.add_argument("--match-rotations", type=float, nargs="+", help="override MATCH_ROTATIONS for this run")
+    bench.add_argument("--out", help="write the JSON here instead of stdout")
+    server = commands.add_parser("record-server", help="serve " + DB_PATH + " to app workers on other processes or nodes")
+    server.add_argument("--host", default="127.0.0.1")
+    server.add_argument("--port", type=int, default=8100)
+    loadtest = commands.add_parser("loadtest", help="measure /upload throughput per uvicorn worker count, prints JSON")
+    loadtest.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    loadtest.add_argument("--url", help="test a running deployment instead of starting uvicorn")
+    loadtest.add_argument("--requests", type=int, default=40)
+    loadtest.add_argument("--concurrency", type=int, default=8)
+    loadtest.add_argument("--photos", type=int, default=2, help="photos per upload")
+    loadtest.add_argument("--size", type=int, default=1600, help="synthetic photo width in pixels")
+    loadtest.add_argument("--port", type=int, default=8765)
+    loadtest.add_argument("--out", help="write the JSON here instead of stdout")
+    args = parser.parse_args()
 
-# init database
-init_db()
+    if args.command == "backfill-detections":
+        backfill_detections(args.batch)
+    elif args.command == "build-index":
+        if not TEMPLATE_INDEX_PATH:
+            raise SystemExit("TEMPLATE_INDEX_PATH is not set")
+        count, size = build_template_index()
+        print("{} templates, {} bytes -> {}".format(count, size, TEMPLATE_INDEX_PATH))
+    elif args.command == "bench":
+        if args.engine:
+            MATCH_ENGINE = args.engine
+        if args.threshold is not None:
+            THRESHOLD = args.threshold
+        if args.match_scales:
+            MATCH_SCALES = tuple(args.match_scales)
+        if args.match_rotations:
+            MATCH_ROTATIONS = tuple(args.match_rotations)
+        report = run_benchmark(args.sizes, args.library, args.images, tuple(args.scale), args.noise, args.seed,
+                               args.tilt)
+    elif args.command == "record-server":
+        import uvicorn
+        uvicorn.run(record_server_app(), host=args.host, port=args.port)
+    elif args.command == "loadtest":
+        report = run_loadtest(args.url, args.workers, args.requests, args.concurrency, args.photos, args.size,
+                              args.port)
+    if args.command in ("bench", "loadtest"):
+        report["config"]["timestamp"] = datetime.utcnow().isoformat()
+        output = json.dumps(report, ensure_ascii=False, indent=2)
+        if args.out:
+            with open(args.out, "w", encoding="utf-8") as f:
+                f.write(output + "\n")
+        else:
+            print(output)
+    sys.exit(0)